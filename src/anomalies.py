@@ -0,0 +1,201 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+import pandas as pd
+import streamlit as st
+from queries import CACHE_MAX_ENTRIES, fetch_transactions, table_version
+
+"""
+Spending anomalies of the insights page, robust z-scores (median / MAD) against what came before:
+score_frame -> one vectorized pass over a bank's debits
+    |- daily spend (calendar days, zero filled) against the rolling median / MAD of the previous BASELINE_DAYS days
+    |- each transaction against the rolling median / MAD of the same merchant's previous BASELINE_DAYS days
+high_spend_windows -> consecutive flagged days merged into periods
+find_anomalies -> scores cached per (bank table, month), a wider date range only scores the months not seen yet
+    |- month_scores -> the missing months of a table are fetched in one query (with their history) and scored in one pass
+"""
+
+# days of history behind every baseline
+BASELINE_DAYS = 90
+# days fetched before the first scored day, a MAD window looks at residuals of BASELINE_DAYS days that each need
+# their own BASELINE_DAYS of history, so scores don't depend on where the fetched range starts
+HISTORY_DAYS = 2 * BASELINE_DAYS
+# robust z-score above which a day or transaction is flagged (Iglewicz and Hoaglin)
+Z_THRESHOLD = 3.5
+# observations a baseline needs before anything is flagged against it
+MIN_HISTORY = 5
+# smallest MAD used, keeps merchants charging the same amount every time from flagging cents of difference
+MAD_FLOOR = 1.0
+# scales MAD to the standard deviation of normally distributed data
+MAD_SCALE = 0.6745
+
+
+def robust_z(values: pd.Series, median: pd.Series, mad: pd.Series) -> pd.Series:
+    return MAD_SCALE * (values - median) / np.maximum(mad, MAD_FLOOR)
+
+
+def daily_scores(debits: pd.DataFrame, start_date: str, end_date: str) -> pd.DataFrame:
+    """ Spend per calendar day with its rolling baseline
+
+    Args:
+        debits (pd.DataFrame): debit transactions, transactdate as datetime64
+        start_date (str): first day of the baseline history as YYYY-MM-DD
+        end_date (str): last day scored as YYYY-MM-DD
+
+    Returns:
+        pd.DataFrame: transactdate, spend, baseline (median), mad, z, flagged
+    """
+    days = pd.date_range(start_date, end_date, freq='D', name='transactdate')
+    spend = debits.groupby('transactdate')['amount'].sum().reindex(days, fill_value=0.0)
+    window = spend.rolling(f"{BASELINE_DAYS}D", closed='left', min_periods=MIN_HISTORY)
+    median = window.median()
+    mad = (spend - median).abs().rolling(f"{BASELINE_DAYS}D", closed='left', min_periods=MIN_HISTORY).median()
+    z = robust_z(spend, median, mad)
+    return pd.DataFrame({'spend': spend, 'baseline': median, 'mad': mad, 'z': z,
+                         'flagged': (z > Z_THRESHOLD) & (spend > 0)}).reset_index()
+
+
+def transaction_scores(debits: pd.DataFrame) -> pd.DataFrame:
+    """ Each transaction against the previous BASELINE_DAYS days of the same merchant
+
+    Args:
+        debits (pd.DataFrame): debit transactions, transactdate as datetime64
+
+    Returns:
+        pd.DataFrame: the transactions with baseline (median), mad, z and flagged columns
+    """
+    debits = debits.sort_values('transactdate', kind='stable').reset_index(drop=True)
+    median = merchant_rolling_median(debits, debits['amount'])
+    mad = merchant_rolling_median(debits, (debits['amount'] - median).abs())
+    z = robust_z(debits['amount'], median, mad)
+    return debits.assign(baseline=median, mad=mad, z=z, flagged=z > Z_THRESHOLD)
+
+
+def merchant_rolling_median(debits: pd.DataFrame, values: pd.Series) -> pd.Series:
+    # median of values over the previous BASELINE_DAYS days of the row's merchant, debits sorted by date
+    by_merchant = debits[['transactdetail', 'transactdate']].assign(value=values).groupby('transactdetail', sort=False, observed=True)
+    rolled = by_merchant.rolling(f"{BASELINE_DAYS}D", on='transactdate', closed='left', min_periods=MIN_HISTORY)['value'].median()
+    # results come merchant by merchant in row order, a stable sort of the group numbers maps them back to the rows
+    rows = np.argsort(by_merchant.ngroup().to_numpy(), kind='stable')
+    median = np.empty(len(debits))
+    median[rows] = rolled.to_numpy()
+    return pd.Series(median, index=debits.index)
+
+
+def score_frame(transactions: pd.DataFrame, start_date: str, end_date: str):
+    """ Daily and per transaction scores of one bank, history before start_date only feeds the baselines
+
+    Args:
+        transactions (pd.DataFrame): purchasetype, transactdetail, transactdate, amount from start_date - HISTORY_DAYS
+        start_date (str): first day scored as YYYY-MM-DD
+        end_date (str): last day scored as YYYY-MM-DD
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: scored days and scored transactions between the two dates
+    """
+    history_start = (pd.Timestamp(start_date) - pd.Timedelta(days=HISTORY_DAYS)).strftime('%Y-%m-%d')
+    debits = transactions.loc[transactions['purchasetype'] == 'Debit', ['transactdetail', 'transactdate', 'amount']]
+    debits = debits.assign(transactdate=pd.to_datetime(debits['transactdate']), amount=debits['amount'].astype(float))
+    days = daily_scores(debits, history_start, end_date)
+    scored = transaction_scores(debits)
+    in_range = lambda df: df[df['transactdate'].between(start_date, end_date)].reset_index(drop=True)
+    return in_range(days), in_range(scored)
+
+
+def high_spend_windows(days: pd.DataFrame) -> pd.DataFrame:
+    """ Runs of consecutive flagged days
+
+    Args:
+        days (pd.DataFrame): scored days of one or more banks, with a bank column
+
+    Returns:
+        pd.DataFrame: bank, start, end, days, spend, baseline and peak_z of each window, largest excess first
+    """
+    days = days.sort_values(['bank', 'transactdate'])
+    # a new run starts whenever the flag or the bank changes
+    run = ((days['flagged'] != days['flagged'].shift()) | (days['bank'] != days['bank'].shift())).cumsum()
+    flagged = days[days['flagged']]
+    windows = flagged.groupby(run[days['flagged']]).agg(bank=('bank', 'first'), start=('transactdate', 'min'), end=('transactdate', 'max'),
+                                                          days=('transactdate', 'size'), spend=('spend', 'sum'),
+                                                          baseline=('baseline', 'sum'), peak_z=('z', 'max'))
+    return windows.assign(excess=windows['spend'] - windows['baseline']).sort_values('excess', ascending=False).reset_index(drop=True)
+
+
+# scored months kept per (table, month, table version), least recently used are dropped first
+MAX_SCORED_MONTHS = CACHE_MAX_ENTRIES * 4
+
+_scored_lock = threading.Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def _scored_months() -> OrderedDict:
+    return OrderedDict()
+
+
+def month_scores(table: str, months: list) -> dict:
+    """ Scored days and transactions of each month, months not cached yet are scored together
+
+    Args:
+        table (str): bank table name
+        months (list): consecutive months as YYYY-MM
+
+    Returns:
+        dict: month with its (scored days, scored transactions)
+    """
+    version = table_version(table)
+    cache = _scored_months()
+    scored = {}
+    with _scored_lock:
+        for month in months:
+            if (table, month, version) in cache:
+                cache.move_to_end((table, month, version))
+                scored[month] = cache[(table, month, version)]
+    missing = [month for month in months if month not in scored]
+    if not missing:
+        return scored
+
+    # one fetch from the history of the first missing month to the end of the last one, cached months in between are rescored
+    first_day = pd.Timestamp(f"{missing[0]}-01")
+    last_day = pd.Timestamp(f"{missing[-1]}-01") + pd.offsets.MonthEnd(0)
+    transactions = fetch_transactions(table, (first_day - pd.Timedelta(days=HISTORY_DAYS)).strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d'))
+    days, scored_transactions = score_frame(transactions, first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d'))
+    day_months = days['transactdate'].dt.strftime('%Y-%m')
+    transaction_months = scored_transactions['transactdate'].dt.strftime('%Y-%m')
+    for month in missing:
+        scored[month] = (days[day_months == month].reset_index(drop=True),
+                         scored_transactions[transaction_months == month].reset_index(drop=True))
+    with _scored_lock:
+        for month in missing:
+            cache[(table, month, version)] = scored[month]
+        while len(cache) > MAX_SCORED_MONTHS:
+            cache.popitem(last=False)
+    return scored
+
+
+def find_anomalies(tables: tuple, start_date: str, end_date: str) -> dict:
+    """ Outlier transactions and high-spend windows of the bank tables between two dates (inclusive)
+
+    Args:
+        tables (tuple): bank table names
+        start_date (str): start date as YYYY-MM-DD
+        end_date (str): end date as YYYY-MM-DD
+
+    Returns:
+        dict: 'days' (scored days), 'transactions' (flagged transactions, highest z first) and 'windows'
+            (high_spend_windows), every frame with a bank column
+    """
+    months = list(pd.period_range(start_date, end_date, freq='M').strftime('%Y-%m'))
+    days, transactions = [], []
+    for table in tables:
+        scored = month_scores(table, months)
+        for month in months:
+            month_days, month_transactions = scored[month]
+            days.append(month_days.assign(bank=table))
+            transactions.append(month_transactions[month_transactions['flagged']].assign(bank=table))
+    days = pd.concat(days, ignore_index=True)
+    days = days[days['transactdate'].between(start_date, end_date)]
+    transactions = pd.concat(transactions, ignore_index=True)
+    transactions = transactions[transactions['transactdate'].between(start_date, end_date)]
+    return {'days': days.reset_index(drop=True),
+            'transactions': transactions.sort_values('z', ascending=False).reset_index(drop=True),
+            'windows': high_spend_windows(days)}
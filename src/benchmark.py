@@ -0,0 +1,341 @@
+import argparse
+from contextlib import contextmanager
+import io
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from anomalies import HISTORY_DAYS, score_frame
+from extract_transactions import DATE_FORMAT_HINTS, clean_data, prepare_dataframe, read_statement
+from migrations import duckdb_schema
+from queries import AGGREGATE_QUERIES, BANK_TABLES, TRANSACTION_COLUMNS
+from storage import DuckDBBackend, duckdb
+from utils import insert_data_to_table, schema_template
+
+"""
+Benchmarks for ingest and insights:
+generate_statement -> synthetic Amex / Scotia credit / Scotia debit csv in the bank's export layout
+SQLiteConnection -> in-memory stand-in for the MariaDB connection (same connection/cursor calls)
+run_benchmarks -> times parse, clean, insert and query+aggregate per bank and size, peak memory and rows/sec
+    |- insert and query+aggregate run once per backend: sqlite (MariaDB stand-in) and/or the embedded duckdb backend
+anomaly_scaling -> anomaly scoring of 1..n years of history in one pass, time per row should stay flat (linear scaling)
+startup_time -> time to first paint of the login form, each run in a fresh interpreter (cold imports)
+
+Usage: python benchmark.py [--rows 1000 10000 100000] [--banks amex_green ...] [--backends sqlite duckdb] [--anomaly-years 4 16 64] [--startup-runs 5] [--output results.json]
+"""
+
+MERCHANTS = ['LOBLAWS 1034  TORONTO ON', 'TIM HORTONS #4432  OTTAWA ON', 'UBER* EATS  HELP.UBER.COM', 'NETFLIX.COM  866-579-7172',
+             'SHOPPERS DRUG MART #12  TORONTO', 'PRESTO FARE  TORONTO', 'AMAZON.CA*MK2P  AMAZON.CA', 'ROGERS  WIRELESS',
+             'SHELL C12345  MISSISSAUGA', 'COSTCO WHOLESALE W1234  ETOBICOKE', 'STARBUCKS 800-782-7282  TORONTO', 'FREE CAFE  APOS BAR']
+# modules the login form should not need, reported by the startup scenario when a run loaded them
+HEAVY_MODULES = ('pandas', 'numpy', 'mysql.connector', 'pyarrow')
+
+# one cold run of the app up to the login form, the server has streamlit imported already
+STARTUP_SCRIPT = """
+import sys, time
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file({path!r}, default_timeout=120)
+started = time.perf_counter()
+app.run()
+assert app.text_input[0].label == 'Username', 'login form not rendered'
+print(time.perf_counter() - started)
+print(','.join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+# days covered by a generated statement, a few years of history whatever the row count
+STATEMENT_DAYS = 3 * 365
+
+DEBIT_TYPES = ['POS Purchase', 'Bill Payment', 'Miscellaneous Payment', 'Withdrawal', 'Deposit', 'Payroll Deposit', 'Transfer', 'Service charge']
+
+
+def generate_statement(bank_name: str, rows: int, seed: int = 0, days: int = STATEMENT_DAYS) -> bytes:
+    """ Synthetic statement in the column layout and date format of the bank export
+
+    Args:
+        bank_name (str): bank table name
+        rows (int): number of transactions
+        seed (int, optional): random seed. Defaults to 0.
+        days (int, optional): days covered up to 2024-12-31, larger statements get more transactions per day.
+            Defaults to STATEMENT_DAYS.
+
+    Returns:
+        bytes: csv content as uploaded by the user
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp('2024-12-31') - pd.to_timedelta(rng.integers(0, days, rows), unit='D')
+    dates = pd.Series(dates).dt.strftime(DATE_FORMAT_HINTS[bank_name])
+    details = rng.choice(MERCHANTS, rows)
+    amounts = np.round(rng.gamma(2.0, 30.0, rows), 2)
+    refunds = rng.random(rows) < 0.1
+
+    if bank_name == 'amex_green':
+        # spend is positive, payments and refunds negative
+        df = pd.DataFrame({'date': dates, 'detail': details, 'amount': np.where(refunds, -amounts, amounts)})
+    elif bank_name == 'scotia_visa_credit':
+        # spend is negative, payments positive
+        details = np.where(refunds, 'FROM - *****12*3456', details)
+        df = pd.DataFrame({'date': dates, 'detail': details, 'amount': np.where(refunds, amounts, -amounts)})
+    else:
+        kinds = rng.choice(DEBIT_TYPES, rows)
+        incoming = np.isin(kinds, ['Deposit', 'Payroll Deposit'])
+        df = pd.DataFrame({'date': dates, 'amount': np.where(incoming, amounts * 10, -amounts), 'type': kinds, 'detail': details})
+    return df.to_csv(header=False, index=False).encode()
+
+
+class SQLiteCursor():
+    def __init__(self, connection, database: str) -> None:
+        self.__cursor = connection.cursor()
+        self.__database = database
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, query: str, params: tuple = ()):
+        # translate the MariaDB dialect used by the app
+        query = query.replace('%s', '?').replace('INSERT IGNORE', 'INSERT OR IGNORE')
+        if query.strip().rstrip(';').upper() == 'SHOW TABLES':
+            query = f"SELECT name FROM {self.__database}.sqlite_master WHERE type = 'table'"
+        self.__cursor.execute(query, params)
+        self.rowcount = self.__cursor.rowcount
+        self.description = self.__cursor.description
+
+    @property
+    def column_names(self):
+        return tuple(col[0] for col in self.description or ())
+
+    def fetchall(self):
+        return self.__cursor.fetchall()
+
+    def fetchone(self):
+        return self.__cursor.fetchone()
+
+    def close(self):
+        self.__cursor.close()
+
+
+class SQLiteConnection():
+    def __init__(self, database: str = 'bench') -> None:
+        """ In-memory database with the bank tables of the latest migration, attached under the app database name
+
+        Args:
+            database (str, optional): name used as database prefix in queries. Defaults to 'bench'.
+        """
+        self.database = database
+        self.__connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.__connection.execute(f"ATTACH DATABASE ':memory:' AS {database}")
+        for table in BANK_TABLES:
+            self.__connection.execute(f"CREATE TABLE {database}.{table}(id INTEGER PRIMARY KEY AUTOINCREMENT, purchasetype TEXT NOT NULL, "
+                                      "transactdetail TEXT NOT NULL, transactdate TEXT NOT NULL, amount REAL NOT NULL, "
+                                      "UNIQUE(transactdate, transactdetail, amount, purchasetype))")
+            self.__connection.execute(f"CREATE INDEX {database}.idx_{table}_date_detail ON {table}(transactdate, transactdetail)")
+
+    def cursor(self):
+        return SQLiteCursor(self.__connection, self.database)
+
+    def commit(self):
+        self.__connection.commit()
+
+    def rollback(self):
+        self.__connection.rollback()
+
+    def ping(self, **kwargs):
+        pass
+
+    def close(self):
+        self.__connection.close()
+
+
+def measure(scenario, memory: bool = True, reset=None):
+    """ Wall time of scenario(), then its peak traced memory in a second run
+
+    Args:
+        scenario (Callable): work to measure
+        memory (bool, optional): run it a second time under tracemalloc. Defaults to True.
+        reset (Callable, optional): puts back the state the first run started from before the memory run. Defaults to None.
+
+    Returns:
+        Tuple: scenario result, seconds, peak MB (None without memory)
+    """
+    started = time.perf_counter()
+    result = scenario()
+    seconds = time.perf_counter() - started
+    peak_mb = None
+    if memory:
+        if reset:
+            reset()
+        tracemalloc.start()
+        scenario()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result, seconds, peak_mb
+
+
+def run_benchmarks(rows_list: list, banks: list, memory: bool = True, backends: list = ('sqlite',)) -> list:
+    results = []
+
+    def record(scenario, bank_name, rows, seconds, peak_mb):
+        results.append({'scenario': scenario, 'bank': bank_name, 'rows': rows, 'seconds': round(seconds, 6), 'backend': backend,
+                        'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+                        'peak_mb': round(peak_mb, 3) if peak_mb is not None else None})
+        print(f"{scenario + (f' [{backend}]' if backend else ''):<26}{bank_name:<20}{rows:>10} rows {seconds:>10.4f}s {results[-1]['rows_per_sec'] or 0:>14,.0f} rows/s")
+
+    for rows in rows_list:
+        for bank_name in banks:
+            data = generate_statement(bank_name, rows)
+
+            backend = None
+
+            def parse():
+                return pd.concat([prepare_dataframe(chunk, bank_name) for chunk in read_statement(io.BytesIO(data), bank_name)])
+            prepared, seconds, peak = measure(parse, memory)
+            record('parse', bank_name, rows, seconds, peak)
+
+            cleaned, seconds, peak = measure(lambda: clean_data(prepared.copy()), memory)
+            record('clean', bank_name, rows, seconds, peak)
+
+            for backend in backends:
+                store = SQLiteBackend() if backend == 'sqlite' else duckdb_bench_backend()
+
+                def insert():
+                    with store.connection() as (conn, cur):
+                        return store.insert_frame(conn, cur, bank_name, cleaned)
+
+                def empty_table():
+                    # the memory run inserts into an empty table again, not one where every row is a duplicate
+                    with store.connection() as (conn, cur):
+                        cur.execute(f"DELETE FROM {bank_name}")
+                        conn.commit()
+                _, seconds, peak = measure(insert, memory, reset=empty_table)
+                record('insert', bank_name, rows, seconds, peak)
+
+                def query_aggregate():
+                    params = ('2000-01-01', '2100-01-01')
+                    with store.connection() as (_, cur):
+                        frames = [store.read_frame(cur, f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM {bank_name} WHERE transactdate BETWEEN %s AND %s",
+                                                   params, TRANSACTION_COLUMNS)]
+                        for query, columns in AGGREGATE_QUERIES.values():
+                            frames.append(store.read_frame(cur, query.format(table=bank_name), params, columns))
+                    return frames
+                _, seconds, peak = measure(query_aggregate, memory)
+                record('query+aggregate', bank_name, rows, seconds, peak)
+                store.close()
+    return results
+
+
+class SQLiteBackend():
+    def __init__(self) -> None:
+        """ Storage backend calls over SQLiteConnection, inserts go through the app's multi-row INSERT IGNORE """
+        self.__conn = SQLiteConnection()
+
+    @contextmanager
+    def connection(self):
+        yield self.__conn, self.__conn.cursor()
+
+    def insert_frame(self, conn, cur, table: str, df: pd.DataFrame) -> int:
+        col_names, _, total_fields = schema_template(df)
+        return insert_data_to_table(conn, cur, conn.database, table, total_fields, col_names, df)
+
+    def read_frame(self, cur, query: str, params: tuple, columns: list) -> pd.DataFrame:
+        cur.execute(query, params)
+        return pd.DataFrame(cur.fetchall(), columns=columns)
+
+    def close(self) -> None:
+        self.__conn.close()
+
+
+def duckdb_bench_backend() -> DuckDBBackend:
+    # throwaway in-memory database with the schema the app creates
+    backend = DuckDBBackend(':memory:')
+    with backend.connection() as (_, cur):
+        duckdb_schema(cur)
+    return backend
+
+
+def anomaly_scaling(years_list: list, memory: bool = True) -> list:
+    """ Scoring time of whole histories, generated statements have 5 transactions a day
+
+    Args:
+        years_list (list): history lengths in years
+
+    Returns:
+        list: result rows of the anomalies scenario, seconds_per_row shows how far from linear the scaling is
+    """
+    results = []
+    for years in years_list:
+        rows = years * 365 * 5
+        df = pd.concat([clean_data(prepare_dataframe(chunk, 'amex_green'))
+                        for chunk in read_statement(io.BytesIO(generate_statement('amex_green', rows, days=years * 365)), 'amex_green')], ignore_index=True)
+        start_date = (pd.Timestamp(df['transactdate'].min()) + pd.Timedelta(days=HISTORY_DAYS)).strftime('%Y-%m-%d')
+        (days, scored), seconds, peak_mb = measure(lambda: score_frame(df, start_date, df['transactdate'].max()), memory)
+        results.append({'scenario': 'anomalies', 'bank': 'amex_green', 'rows': rows, 'years': years, 'seconds': round(seconds, 6),
+                        'rows_per_sec': round(rows / seconds, 1), 'peak_mb': round(peak_mb, 3) if peak_mb is not None else None,
+                        'seconds_per_row': seconds / rows, 'flagged_transactions': int(scored['flagged'].sum()),
+                        'flagged_days': int(days['flagged'].sum())})
+        print(f"{'anomalies':<26}{f'{years} years':<20}{rows:>10} rows {seconds:>10.4f}s {rows / seconds:>14,.0f} rows/s")
+    if len(results) > 1:
+        # per row cost of the longest history relative to the shortest, close to 1 for linear scaling
+        print(f"{'anomalies':<26}{'scaling':<20}{results[-1]['seconds_per_row'] / results[0]['seconds_per_row']:>10.2f}x time per row "
+              f"for {results[-1]['years'] / results[0]['years']:.0f}x the history")
+    return results
+
+
+def startup_time(runs: int = 5) -> dict:
+    """ Script run time of initialize.py until the login form is rendered
+
+    Args:
+        runs (int, optional): fresh interpreters to time. Defaults to 5.
+
+    Returns:
+        dict: startup result row with the median seconds and the heavy modules the login form loaded
+    """
+    script = STARTUP_SCRIPT.format(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "initialize.py"), heavy=HEAVY_MODULES)
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout.split('\n')
+        timings.append(float(output[0]))
+        loaded = [name for name in output[1].split(',') if name]
+    seconds = statistics.median(timings)
+    print(f"{'startup':<26}{'login form':<20}{runs:>10} runs {seconds:>10.4f}s  loaded: {', '.join(loaded) or 'none'}")
+    return {'scenario': 'startup', 'bank': None, 'rows': None, 'seconds': round(seconds, 6), 'rows_per_sec': None, 'peak_mb': None,
+            'runs': [round(t, 6) for t in timings], 'heavy_modules': loaded}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Benchmark ingest and insights queries on synthetic statements")
+    args.add_argument("--rows", type=int, nargs='+', default=[1000, 10000, 100000], help="statement sizes to generate")
+    args.add_argument("--banks", nargs='+', default=list(BANK_TABLES), choices=BANK_TABLES, help="bank layouts to generate")
+    args.add_argument("--backends", nargs='+', default=['sqlite'], choices=['sqlite', 'duckdb'], help="storage backends for insert and query+aggregate")
+    args.add_argument("--no-memory", action="store_true", help="skip the traced peak memory runs")
+    args.add_argument("--anomaly-years", type=int, nargs='*', default=[4, 16, 64], help="history lengths for the anomaly scaling runs, none skips them")
+    args.add_argument("--startup-runs", type=int, default=5, help="cold starts of the login form to time, 0 skips them")
+    args.add_argument("--output", default=None, help="json file for the results. Defaults to benchmark_<commit>.json")
+    options = args.parse_args()
+
+    commit = git_commit()
+    if 'duckdb' in options.backends and duckdb is None:
+        args.error("the duckdb backend needs the duckdb package")
+    results = run_benchmarks(options.rows, options.banks, memory=not options.no_memory, backends=options.backends)
+    if options.anomaly_years:
+        results += anomaly_scaling(options.anomaly_years, memory=not options.no_memory)
+    if options.startup_runs:
+        results.append(startup_time(options.startup_runs))
+    report = {'commit': commit, 'timestamp': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'pandas': pd.__version__, 'results': results}
+    output = options.output or f"benchmark_{commit or 'local'}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
@@ -1,9 +1,14 @@
-import pandas as pd
 import streamlit as st
-from utils import connect_to_mysql
-import warnings
-warnings.filterwarnings("ignore", message="pandas only supports SQLAlchemy connectable")
-import time
+from anomalies import BASELINE_DAYS, find_anomalies
+from downsample import CHART_POINT_BUDGET, bucket_frame, choose_bucket
+from queries import BANK_TABLES, fetch_accounts_aggregate
+from telemetry import trace
+
+# per-store daily charts rendered per page, ordered by total spend
+STORES_PER_PAGE = 12
+
+# bank option combining every bank table
+ALL_ACCOUNTS = "All Accounts"
 
 class Generate_insights():
     def __init__(self) -> None:
@@ -11,35 +16,40 @@ class Generate_insights():
         self.end_date = None
         self.selected_bank = None
         self.table = None
+        self.tables = ()
         self.__validated = False
-        self.conn = None
-        self.cur = None
-        self.df = None
         self.__validated = False
         self.get_date_range_and_bank()
         self.create_graphs()
     
     def get_date_range_and_bank(self):
-        bank_options = ["American Express", "Scotia Bank Debit", "Scotia Bank Credit"]
+        bank_options = ["American Express", "Scotia Bank Debit", "Scotia Bank Credit", ALL_ACCOUNTS]
         with st.container(border=True):
             st.subheader("Select Date Range To Create Insights")
             self.start_date = st.date_input(label="Start Date").strftime("%Y-%m-%d")
             self.end_date = st.date_input(label="End Date").strftime("%Y-%m-%d")
             self.selected_bank = st.selectbox(label="Select Bank", options=bank_options)
 
-            if st.button(label="Generate"):
-                if self.start_date >= self.end_date:
-                    st.toast("Start date should be less than end date!")
-                    self.__validated = False
-                else:
-                    self.__validated = True
-                        
             bank_table_mapping = {
                 "American Express": "amex_green",
                 "Scotia Bank Debit": "scotia_visa_debit",
                 "Scotia Bank Credit": "scotia_visa_credit"
             }
             self.table = bank_table_mapping.get(self.selected_bank)
+            # all accounts render every bank table combined
+            self.tables = (self.table,) if self.table else BANK_TABLES
+            self.bank_labels = {table: bank for bank, table in bank_table_mapping.items()}
+
+            # remember the generated request so widget interactions (show more) keep the charts on rerun
+            request = (self.tables, self.start_date, self.end_date)
+            if st.button(label="Generate"):
+                if self.start_date >= self.end_date:
+                    st.toast("Start date should be less than end date!")
+                    st.session_state.insights_request = None
+                else:
+                    st.session_state.insights_request = request
+                    st.session_state.stores_shown = STORES_PER_PAGE
+            self.__validated = st.session_state.get('insights_request') == request
         return
         
     def create_graphs(self):
@@ -47,8 +57,12 @@ class Generate_insights():
             return
         
         with st.spinner("Getting data & Plotting Charts..."):
-            time.sleep(5)
-            if not self.get_data_to_dataframe(): # getting data from server and loading to dataframe
+            # summaries are grouped on the server, only the small result sets are transferred (one query per bank, in parallel)
+            with trace('chart: credit/debit totals') as span:
+                accounts_in_out = fetch_accounts_aggregate('purchasetype', self.tables, self.start_date, self.end_date)
+                grouped_df_in_out = accounts_in_out.groupby('purchasetype', as_index=False, observed=True)['amount'].sum()
+                span['rows'] = len(accounts_in_out)
+            if grouped_df_in_out.empty:
                 st.error("No Transactions Found!")
                 return
 
@@ -56,14 +70,28 @@ class Generate_insights():
             with st.container():
                 st.title("Graphical Insights")
  
-            with st.container(border=True):
+            with st.container(border=True), trace('chart: grouped categories') as span:
                 # TODO: create piechart(from plotly) that shows total income, spent :::> next to it shows bank name, Total income(total credit), total spent(total debit)
                 col1= st.columns(1)[0]
                 with col1:
                     st.subheader("Grouped Categories")
-                    grouped_category_data = self.df.groupby('transactdetail')['amount'].sum().reset_index()
+                    accounts_category_data = fetch_accounts_aggregate('category', self.tables, self.start_date, self.end_date)
+                    grouped_category_data = accounts_category_data.groupby('transactdetail', as_index=False, observed=True)['amount'].sum()
                     grouped_category_data['amount'] = grouped_category_data['amount'].apply(lambda x: f"{x:.2f}")
                     st.scatter_chart(grouped_category_data, x='transactdetail', y="amount")
+                    span['rows'] = len(accounts_category_data)
+
+            if len(self.tables) > 1:
+                # combined view above, split per account here
+                with st.container(border=True), trace('chart: per-account breakdown'):
+                    st.subheader("Per-Account Breakdown")
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        in_out_by_bank = accounts_in_out.pivot_table(index='bank', columns='purchasetype', values='amount', aggfunc='sum', observed=True).rename(index=self.bank_labels)
+                        st.bar_chart(in_out_by_bank, stack=False)
+                    with col2:
+                        st.scatter_chart(accounts_category_data.assign(bank=accounts_category_data['bank'].map(self.bank_labels)),
+                                         x='transactdetail', y='amount', color='bank')
                                
 
             # TODO: create barchart for all of the transactions grouped by itself and show on daily bases (x-axis date, y-axis amount -> label store name and total spent)
@@ -72,44 +100,81 @@ class Generate_insights():
             
             
             st.title("Daily-Transactions")
-            with st.container(border=True):
-                self.df['transactdate'] = pd.to_datetime(self.df['transactdate'])
-                stores = self.df['transactdetail'].unique()
+            with st.container(border=True), trace('chart: daily transactions') as span:
+                daily_store_data = fetch_accounts_aggregate('daily_store', self.tables, self.start_date, self.end_date)
+                # one pass: date x store matrix, stores ordered by total spend
+                daily_matrix = daily_store_data.pivot_table(index='transactdate', columns='transactdetail', values='amount', aggfunc='sum', observed=True)
+                stores = daily_matrix.sum().sort_values(ascending=False).index
+                # long ranges are drawn in weekly or monthly bars so every chart stays under the point budget
+                freq, bucket = choose_bucket(self.start_date, self.end_date)
+                store_matrix = bucket_frame(daily_matrix, freq)
+                if freq != 'D':
+                    st.caption(f"{bucket.capitalize()} totals, the range has more than {CHART_POINT_BUDGET} days per chart")
+                stores_shown = st.session_state.get('stores_shown', STORES_PER_PAGE)
+                span['rows'] = len(daily_store_data)
                 
-                # Loop through each store and plot charts in rows of 3 columns
+                # Loop through top stores and plot charts in rows of 3 columns
                 cols_per_row = 3  # Number of charts per row
                 col_idx = 0  # To track column position
                 
-                for i, store in enumerate(stores):
+                for i, store in enumerate(stores[:stores_shown]):
                     if col_idx == 0:  # Create new row if at the start of the row
                         cols = st.columns(cols_per_row)
                     
-                    store_data = self.df[self.df['transactdetail'] == store].set_index('transactdate')
+                    store_data = store_matrix[[store]].dropna().rename(columns={store: 'amount'})
                     
                         # Display the chart in the appropriate column
                     with cols[col_idx]:
                         st.write(f'### {store.capitalize()}')
-                        st.bar_chart(store_data[['amount']])
+                        st.bar_chart(store_data)
                     
                     # Update column index, and reset to 0 after 3 columns
                     col_idx = (col_idx + 1) % cols_per_row
+                
+                if stores_shown < len(stores):
+                    st.caption(f"Showing top {stores_shown} of {len(stores)} stores by spend")
+                    st.button(label="Show more", on_click=self.show_more_stores)
+            
+            # days and transactions standing out from their rolling baselines (README: anomalies, high expenditure periods)
+            st.title("Anomalies")
+            with st.container(border=True), trace('chart: anomalies') as span:
+                anomalies = find_anomalies(self.tables, self.start_date, self.end_date)
+                span['rows'] = len(anomalies['days'])
+                daily_spend = anomalies['days'].groupby('transactdate')[['spend', 'baseline']].sum(min_count=1)
+                st.line_chart(bucket_frame(daily_spend, choose_bucket(self.start_date, self.end_date, series=2)[0]))
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.subheader("High-Spend Periods")
+                    windows = anomalies['windows'].assign(bank=anomalies['windows']['bank'].map(self.bank_labels))
+                    if windows.empty:
+                        st.caption(f"No day stands out from the previous {BASELINE_DAYS} days")
+                    else:
+                        st.dataframe(windows.round({'spend': 2, 'baseline': 2, 'peak_z': 2, 'excess': 2}), hide_index=True)
+                with col2:
+                    st.subheader("Unusual Transactions")
+                    outliers = anomalies['transactions']
+                    if outliers.empty:
+                        st.caption(f"No transaction stands out from the previous {BASELINE_DAYS} days of its merchant")
+                    else:
+                        st.dataframe(outliers.assign(bank=outliers['bank'].map(self.bank_labels))
+                                     [['bank', 'transactdate', 'transactdetail', 'amount', 'baseline', 'z']].round({'baseline': 2, 'z': 2}), hide_index=True)
                  
                         
-            with st.sidebar:
+            with st.sidebar, trace('chart: sidebar breakdown'):
             # TODO: Arrange data to table in sidebar
             # TODO: On table show bank name, start and end date below, total spent in tabular form like store grouped by name and total amount beside it
             # example: col1 store name, col2 total amount 
                 st.title("**Transactions Breakdown**")
-                # grouping data in dataframe
-                grouped_df_in_out = self.df.groupby('purchasetype')['amount'].sum().reset_index()
-                grouped_df_in_out.columns = ['purchasetype', 'amount']
-                
-                total_credited = grouped_df_in_out[grouped_df_in_out['purchasetype'] == 'Credit']['amount'].values[0]
-                total_debited = grouped_df_in_out[grouped_df_in_out['purchasetype'] == 'Debit']['amount'].values[0]
+                # credit and debit totals grouped on the server
+                totals = grouped_df_in_out.set_index('purchasetype')['amount'].round(2)
+                total_credited = totals.get('Credit', 0.0)
+                total_debited = totals.get('Debit', 0.0)
                 
                 # Display bank details
                 st.write(f"**Bank:** {self.selected_bank}")                
                 st.write(f"**Transactions From:** {self.start_date}\n**Transactions Till:** {self.end_date}")
+                if len(self.tables) > 1:
+                    st.write(in_out_by_bank.round(2).to_html(), unsafe_allow_html=True)
                 
                 st.markdown(
                     f"<div style='margin-bottom: 20px;'>"
@@ -120,13 +185,6 @@ class Generate_insights():
 
                 st.write(grouped_category_data.to_html(index=False), unsafe_allow_html=True)
         
-    # TODO: Get data for the selected date and bank
-    def get_data_to_dataframe(self):
-        self.conn, self.cur = connect_to_mysql(host=st.secrets['HOST'], user=st.secrets['SERVER_USERNAME'], port=int(st.secrets['PORT']), database=st.secrets['DATABASE'])
-        query = f"SELECT purchasetype, transactdetail, transactdate, amount FROM {self.table} WHERE transactdate BETWEEN '{self.start_date}' AND '{self.end_date}';"
-        self.df = pd.read_sql(query, self.conn) # loading data to dataframe
-
-        if self.df.empty: # verify if dataframe is empty or not
-            return False
-        self.conn.close() # close connection
-        return True
+    @staticmethod
+    def show_more_stores():
+        st.session_state.stores_shown = st.session_state.get('stores_shown', STORES_PER_PAGE) + STORES_PER_PAGE
@@ -0,0 +1,48 @@
+import pandas as pd
+
+"""
+Time series sent to the charts are kept under a point budget:
+choose_bucket -> daily, weekly or monthly buckets, the finest one whose points fit the budget for the date range
+bucket_frame -> sums a date indexed frame into those buckets, each bucket labelled by its first day
+"""
+
+# points drawn per chart (buckets x series), one year of daily bars fits
+CHART_POINT_BUDGET = 366
+
+# pandas period code and label of each bucket size, finest first
+BUCKETS = [('D', 'daily'), ('W', 'weekly'), ('M', 'monthly')]
+
+
+def choose_bucket(start_date: str, end_date: str, series: int = 1, budget: int = CHART_POINT_BUDGET) -> tuple:
+    """ Finest bucket keeping the chart under the point budget, monthly when nothing fits
+
+    Args:
+        start_date (str): start date as YYYY-MM-DD
+        end_date (str): end date as YYYY-MM-DD
+        series (int, optional): series drawn on the chart. Defaults to 1.
+        budget (int, optional): points allowed per chart. Defaults to CHART_POINT_BUDGET.
+
+    Returns:
+        tuple: period code and its label
+    """
+    for freq, label in BUCKETS:
+        if len(pd.period_range(start_date, end_date, freq=freq)) * series <= budget:
+            return freq, label
+    return BUCKETS[-1]
+
+
+def bucket_frame(df: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """ Sum of every column per bucket
+
+    Args:
+        df (pd.DataFrame): numeric columns indexed by datetime64 dates
+        freq (str): period code from choose_bucket
+
+    Returns:
+        pd.DataFrame: one row per bucket holding data, empty buckets stay missing
+    """
+    if freq == 'D':
+        return df
+    buckets = df.groupby(df.index.to_period(freq)).sum(min_count=1)
+    buckets.index = buckets.index.to_timestamp()
+    return buckets
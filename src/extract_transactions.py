@@ -1,19 +1,43 @@
-from utils import connect_to_mysql, insert_data_to_table, schema_template
+from queries import invalidate_table
+from rollups import refresh_rollup
+from merchants import merchant_normalizer
+from ledger import already_ingested, file_digest, new_rows, record_ingest
+from telemetry import PipelineProgress, traced
+from jobs import job_owner, job_runner
+from storage import storage_backend
+from settings import get_setting
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter, sleep
+from typing import Tuple
+import io
+import os
+import numpy as np
 import pandas as pd
-from time import sleep
-from dateutil import parser
 import streamlit as st
 
 """
 Program Algorithm:
 get_statement -> ask user for statements, validate files
-clean_upload_data_toserver
+ingested_files -> files whose hash is in the ingest ledger are skipped
+submit_statements -> one background ingest job per file (jobs.py), the script thread returns at once
+ingest_statement -> body of a job, every file is streamed chunk by chunk
     |- bank_extraction -> gets bank name)
-    |- prepare_dateframe -> it cleans, arranges and returns dataframe for further processing
-    |- clean_data -> cleans transaction detail
-    |- insert_data_to_server -> insert cleaned data to tables in server
+    |- stream_cleaned_chunks -> reads the file in chunks, for each chunk (in the shared process pool when several files are uploaded):
+    |   |- prepare_dateframe -> it cleans, arranges and returns dataframe for further processing
+    |   |- clean_data -> cleans transaction detail
+    |- insert_data_to_server -> insert cleaned chunks to tables in server while the next chunk is prepared
+    |   |- insert_new_rows -> anti-join against stored rows of the chunk's dates, only new rows are inserted
+    |- update_rollup -> recompute monthly_rollup for the months of the upload
 """
 
+# date layout of each bank export, values not matching fall back to generic date parsing
+DATE_FORMAT_HINTS = {
+    'amex_green': '%d %b %Y',
+    'scotia_visa_credit': '%m/%d/%Y',
+    'scotia_visa_debit': '%m/%d/%Y',
+}
+
 def get_statement(st):
     # login state
     if not st.session_state.login_status:
@@ -24,15 +48,33 @@ def get_statement(st):
 File name format: bank_card_till_date_month(3 letters)_year.csv\n\n
 eg.amex_credit_till_15_oct_2024.csv\n\nFile column format: date, transaction detail, amount""")
     
-    statement = st.file_uploader(label="Upload statements", type=['.csv'], accept_multiple_files=False)
+    uploaded = st.file_uploader(label="Upload statements", type=['.csv'], accept_multiple_files=True)
         
     # Proceed to extraction
-    if statement:
+    statements = []
+    for statement in uploaded or []:
         if any(statement.name.lower().startswith(prefix) for prefix in ['scotia_credit','scotia_debit','amex_credit']):
-            st.toast(f"File '{statement.name}' uploaded successfully!")
-            st.button(label="Clean And Store Statements",on_click=clean_upload_data_toserver, args=(st,statement))
+            statements.append(statement)
         else:
-            st.warning("Invalid name format for the file")
+            st.warning(f"Invalid name format for the file '{statement.name}'")
+
+    if statements:
+        st.button(label="Clean And Store Statements", on_click=submit_statements, args=(statements,))
+
+
+def submit_statements(statements):
+    """Queue one ingest job per statement, progress is followed in the ingest jobs panel
+
+    Args:
+        statements (List[UploadedFile]): validated uploaded csv files
+    """
+    runner = job_runner()
+    # chunks of several files are cleaned in parallel processes, a lone file is cleaned on its job thread
+    parallel = len(statements) > 1
+    for statement in statements:
+        # uploads are released after the rerun, the job keeps its own copy of the bytes
+        runner.submit(job_owner(), statement.name, ingest_statement, statement.getvalue(), bank_extraction(statement), statement.name, parallel)
+    st.toast(f"{len(statements)} statements queued, you can keep browsing while they are stored")
 
 
 # split file name and get name of bank
@@ -47,141 +89,284 @@ def bank_extraction(statement):
     return None
 
 
-def clean_upload_data_toserver(st, statement):
-    try:
-        progress = st.progress(0)
-        log_placeholder = st.empty()
-        # Step 1: Read the file (log progress)
-        bank_name = bank_extraction(statement)
-        
-        df = prepare_dataframe(st=st, statement=statement, bank_name=bank_name, progress=progress, log_placeholder=log_placeholder)
-        
-        # Perform data cleaning and transformations
-        log_placeholder.text("Step 5: Cleaning Transaction Details")
-        df_cleaned = clean_data(df)
-        sleep(1)
-        progress.progress(90)
-        
-        # Connect to MySQL and insert cleaned data
-        log_placeholder.text("Step 6: Inserting Data to Server")
-        
-        isinserted = insert_data_to_server(log_placeholder, df_cleaned, bank_name)
-        sleep(1)
-        progress.progress(100)
-        if isinserted:
-            log_placeholder.text("Data Extracted, Cleaned And Stored To Database Successfully!")
-            st.success("Data Processing Successful!")
+# share of the progress bar taken by each step of the pipeline
+PIPELINE_STAGES = {'connect': 5, 'ingest': 95}
+
+# rows read from the uploaded file per chunk, bounds memory use for multi-year exports
+CSV_CHUNK_SIZE = 50000
+
+# refreshes of the monthly rollup tried before the job fails
+ROLLUP_ATTEMPTS = 3
+
+
+def ingest_statement(reporter, data, bank_name, filename, parallel=False):
+    """Steps 1-6 for one statement, runs on a job runner thread
+
+    Args:
+        reporter (JobReporter): progress bar and status line of the job
+        data (bytes): content of the uploaded csv
+        bank_name (str): bank table name
+        filename (str): uploaded file name, kept in the ingest ledger
+        parallel (bool, optional): clean the chunks in the shared process pool, used when several files are uploaded. Defaults to False.
+
+    Returns:
+        dict: job status, rows_total, rows_inserted and message
+    """
+    progress = PipelineProgress(PIPELINE_STAGES, progress_bar=reporter, log_placeholder=reporter)
+    # Step 1: files stored by an earlier upload are skipped before parsing
+    digest = file_digest(data)
+    if ingested_files([digest]):
+        return {'status': 'skipped', 'rows_total': 0, 'rows_inserted': 0, 'message': "Statement already processed, skipped!"}
+    
+    # Steps 2 to 5 run chunk by chunk while the previous chunk is being inserted
+    chunks = stream_cleaned_chunks(io.BytesIO(data), bank_name, progress, chunksize=int(get_setting('CSV_CHUNK_SIZE', CSV_CHUNK_SIZE)),
+                                   parsers=statement_parsers() if parallel else None)
+    rows_inserted, rows_total = insert_data_to_server(progress, chunks, bank_name, total_bytes=len(data), file_hash=digest, filename=filename)
+    
+    status = 'done' if rows_inserted == rows_total else 'duplicates'
+    message = (f"{rows_inserted}/{rows_total} rows stored in {progress.elapsed:.2f}s"
+               + (f", {rows_total - rows_inserted} duplicates skipped" if status == 'duplicates' else "")
+               + f". Stage timings: {progress.summary()}")
+    return {'status': status, 'rows_total': rows_total, 'rows_inserted': rows_inserted, 'message': message}
+
+
+@st.cache_resource(show_spinner=False)
+def statement_parsers():
+    # worker processes shared by the jobs of every session, spawned so they don't inherit the server's threads
+    return ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=get_context('spawn'))
+
+
+def clean_chunk(chunk, bank_name):
+    """Steps 2-5 for one chunk of a statement, runs in a worker process when several files are uploaded
+
+    Args:
+        chunk (pd.DataFrame): raw rows read from the statement
+        bank_name (str): bank table name
+
+    Returns:
+        pd.DataFrame: cleaned transactions ready to insert
+    """
+    return clean_data(prepare_dataframe(chunk, bank_name))
+
+
+def read_statement(statement, bank_name, chunksize=CSV_CHUNK_SIZE):
+    """Read the uploaded statement lazily in chunks of rows
+
+    Args:
+        statement (UploadedFile): uploaded csv file
+        bank_name (str): bank table name, decides the column layout
+        chunksize (int, optional): rows per chunk. Defaults to CSV_CHUNK_SIZE.
+
+    Returns:
+        TextFileReader: iterator of raw dataframes
+    """
+    if bank_name in ['amex_green', 'scotia_visa_credit']:
+        return pd.read_csv(statement, header=None, names=['transactdate', 'transactdetail', 'amount'], chunksize=chunksize)
+    if bank_name == 'scotia_visa_debit':
+        return pd.read_csv(statement, header=None, names=['transactdate', 'amount', 'transactdetail', 'longdetail'], chunksize=chunksize)
+    raise ValueError(f"Unsupported bank '{bank_name}'")
+
+
+def stream_cleaned_chunks(statement, bank_name, progress, chunksize=CSV_CHUNK_SIZE, parsers=None):
+    """Push each chunk of the statement through prepare and clean steps
+
+    Args:
+        parsers (ProcessPoolExecutor, optional): pool cleaning the chunks, one chunk of the file is in a worker at a time.
+            Defaults to None (cleaned on the calling thread).
+
+    Yields:
+        Tuple[pd.DataFrame, int]: cleaned chunk and bytes of the file consumed so far
+    """
+    reader = read_statement(statement, bank_name, chunksize)
+    rows_read = 0
+    while True:
+        with progress.timed('read'):
+            chunk = next(reader, None)
+        if chunk is None:
+            break
+        rows_read += len(chunk)
+        if parsers is not None:
+            with progress.timed('clean'):
+                df_cleaned = parsers.submit(clean_chunk, chunk, bank_name).result()
         else:
-            st.error("Data Processing Failed!")
-    except Exception as e:
-        st.error(f"Data Processing Error! {e}")    
+            with progress.timed('prepare'):
+                df = prepare_dataframe(chunk, bank_name)
+            with progress.timed('clean'):
+                df_cleaned = clean_data(df)
+        progress.log(f"Steps 1-5: {rows_read} rows read and cleaned")
+        yield df_cleaned, statement.tell()
+
+
+@traced('prepare_dataframe')
+def prepare_dataframe(df, bank_name):
+    # Ensure the date column is in the correct format (if needed)
+    df['transactdate'] = parse_dates(df['transactdate'], bank_name).dt.strftime('%Y-%m-%d')  # Convert to desired format
     
-def prepare_dataframe(st, statement, bank_name, progress, log_placeholder):
+    # applying index for dataframe
+    # df['id'] = range(1, len(df) + 1)
     
-    try:
-        # Step 1: Load data from the uploaded file into a DataFrame
-        log_placeholder.text("Step 1: Reading the file...")
-        if bank_name in ['amex_green', 'scotia_visa_credit']:
-            df = pd.read_csv(statement, header=None, names=['transactdate', 'transactdetail', 'amount'])
-        if bank_name == 'scotia_visa_debit':
-            df = pd.read_csv(statement, header=None, names=['transactdate', 'amount', 'transactdetail', 'longdetail'])
-        sleep(1)
-        progress.progress(10)
-        
-        # Ensure the date column is in the correct format (if needed)
-        df['transactdate'] = df['transactdate'].apply(lambda x: parser.parse(x).strftime('%Y-%m-%d') if pd.notnull(x) else None)  # Convert to desired format
-        sleep(0.8)
-        progress.progress(25)
-        
-        # applying index for dataframe
-        # df['id'] = range(1, len(df) + 1)
-        
-        # Step 2: Determine 'PurchaseType' based on the 'amount' column
-        log_placeholder.text("Step 2: Determining type of purchase")
-        if bank_name == 'amex_green':
-            df['purchasetype'] = df['amount'].apply(lambda x: 'Credit' if x < 0 else 'Debit')
-        if bank_name in ['scotia_visa_credit', 'scotia_visa_debit']:
-            df['purchasetype'] = df['amount'].apply(lambda x: 'Credit' if x > 0 else 'Debit')
-        df['amount'] = df['amount'].abs() # changing amount to positive values 
-        sleep(0.75)
-        progress.progress(40)
-        
-        # Step 3: Select and rearrange the columns to match the database table schema
-        log_placeholder.text("Step 3: Rearranging final Dataframe")
-        if bank_name in ['amex_green', 'scotia_visa_credit']:
-            df_final = df[['purchasetype', 'transactdetail', 'transactdate', 'amount']]
-        if bank_name == 'scotia_visa_debit':
-            df_final = df[['purchasetype', 'transactdetail', 'longdetail', 'transactdate', 'amount']]
-        sleep(0.5)
-        progress.progress(55)
-
-        # Step 4: Clean the data (you can customize this part)
-        log_placeholder.text("Step 4: Cleaning the data")
-        df_final.dropna(inplace=True)  # Remove rows with missing values
-        df_final.columns = df_final.columns.str.strip()  # Strip leading/trailing whitespace from column names
-        sleep(1.5)
-        progress.progress(70)
-        return df_final
-    except Exception as e:
-        st.error(e)
+    # Step 2: Determine 'PurchaseType' based on the 'amount' column
+    if bank_name == 'amex_green':
+        df['purchasetype'] = np.where(df['amount'] < 0, 'Credit', 'Debit')
+    if bank_name in ['scotia_visa_credit', 'scotia_visa_debit']:
+        df['purchasetype'] = np.where(df['amount'] > 0, 'Credit', 'Debit')
+    df['amount'] = df['amount'].abs() # changing amount to positive values 
+    
+    # Step 3: Select and rearrange the columns to match the database table schema
+    if bank_name in ['amex_green', 'scotia_visa_credit']:
+        df_final = df[['purchasetype', 'transactdetail', 'transactdate', 'amount']]
+    if bank_name == 'scotia_visa_debit':
+        df_final = df[['purchasetype', 'transactdetail', 'longdetail', 'transactdate', 'amount']]
+
+    # Step 4: Clean the data (you can customize this part)
+    df_final = df_final.dropna()  # Remove rows with missing values
+    df_final.columns = df_final.columns.str.strip()  # Strip leading/trailing whitespace from column names
+    return df_final
+
+def parse_dates(dates, bank_name):
+    """Parse the whole date column at once using the bank's format hint
+
+    Args:
+        dates (pd.Series): raw date strings from the statement
+        bank_name (str): bank table name used to pick the format hint
 
+    Returns:
+        pd.Series: datetime64 series, NaT where the value is missing
+    """
+    parsed = pd.to_datetime(dates, format=DATE_FORMAT_HINTS.get(bank_name), errors='coerce')
+    unparsed = parsed.isna() & dates.notna()
+    if unparsed.any():
+        parsed[unparsed] = pd.to_datetime(dates[unparsed], format='mixed')
+    return parsed
+
+
+@traced('clean_data')
 def clean_data(df):
+    # merchant rules live in merchant_rules.json, each distinct raw detail is normalized once and memoized
+    merchants = merchant_normalizer()
     if "longdetail" in df:
-        # replace deposit, withdrawal to interact etransfer
-        df['transactdetail'] = df['transactdetail'].replace({'deposit': 'Interac e-transfer', 'withdrawal': 'Interac e-transfer'}, regex=True)
-        
-        replacements = ['pos purchase', 'bill payment', 'miscellaneous payment','rent', 'loans', 
-        'investment', 'deposit', 'withdrawal', 'transfer']
+        # replace deposit, withdrawal to interact etransfer, strip and convert to lower case
+        df['transactdetail'] = merchants.apply('debit_prepare', df['transactdetail'])
         
-        # strip and convert to lower case
-        df['transactdetail'] = df['transactdetail'].str.strip().str.lower()
-        df.loc[df['transactdetail'].isin(replacements), 'transactdetail'] = df['longdetail']
+        # generic debit types are replaced by the long detail (payee)
+        df.loc[df['transactdetail'].isin(merchants.debit_generic_types), 'transactdetail'] = df['longdetail']
         
         # if long detail == none, payroll deposit then keep as it is
-        df['transactdetail'] = df.apply(lambda row: 'payroll deposit' if pd.isnull(row['longdetail']) and 'payroll deposit' in row['transactdetail'] else row['transactdetail'], axis=1)
+        payroll = df['longdetail'].isna() & df['transactdetail'].str.contains('payroll deposit', regex=False, na=False)
+        df.loc[payroll, 'transactdetail'] = 'payroll deposit'
         
         # remove longdetail value 
         df.drop('longdetail', axis=1, inplace=True)
     else:
         # renaming inter transfer
-        df.loc[df['transactdetail'].str.contains('FROM - *'), 'transactdetail'] = "Internal Transfer"
+        df['transactdetail'] = merchants.apply('credit_prepare', df['transactdetail'])
 
-    df['transactdetail'] = df['transactdetail'].str.replace(r'apos|free', '', regex=True)
     # remove special symbols and numbers
-    df['transactdetail'] = df['transactdetail'].str.split('  ').str[0].str.replace(r'[^a-zA-Z\s]', '', regex=True).str.lower()
+    df['transactdetail'] = merchants.apply('canonical', df['transactdetail'])
     return df
 
 
-def insert_data_to_server(log_placeholder, df_cleaned, bank_name) -> bool:
-    conn, cur = connect_to_mysql(host=st.secrets['HOST'], user=st.secrets['SERVER_USERNAME'],port=int(st.secrets['PORT']), database=st.secrets['DATABASE'])
-    log_placeholder.text("Connected to Database")
-    sleep(0.5)
+def insert_data_to_server(progress, chunks, bank_name, total_bytes=None, file_hash=None, filename=None) -> Tuple[int, int]:
+    """Insert cleaned chunks while the next one is prepared
+
+    Returns:
+        Tuple[int, int]: rows inserted and rows cleaned, they differ when duplicates were skipped
+    """
+    local_infile = bool(get_setting('LOAD_DATA_LOCAL_INFILE', False))
+    rows_inserted = 0
+    rows_total = 0
+    months = set()
+    try:
+        with storage_backend().connection(allow_local_infile=local_infile) as (conn, cur):
+            with progress.stage('connect'):
+                progress.log("Connected to Database")
+                selected_table = find_bank_table(cur, bank_name)
+        
+            try:
+                # a single writer thread inserts chunk n while chunk n+1 is parsed and cleaned
+                with progress.stage('ingest', "Step 6: Inserting Data to Server"), ThreadPoolExecutor(max_workers=1) as writer:
+                    pending = None
+                    for df_cleaned, bytes_read in chunks:
+                        if pending:
+                            rows_inserted += collect_inserted_chunk(progress, *pending, total_bytes=total_bytes)
+                        future = writer.submit(timed_insert, conn, cur, selected_table, df_cleaned, local_infile)
+                        rows_total += len(df_cleaned)
+                        months.update(df_cleaned['transactdate'].str[:7].unique())
+                        pending = (future, bytes_read)
+                    if pending:
+                        rows_inserted += collect_inserted_chunk(progress, *pending, total_bytes=total_bytes)
+            finally:
+                # recomputed even when nothing new was stored: chunks committed before a failure are kept (a chunk in flight
+                # may be stored without being counted), and a retry of a failed refresh may find every row stored already
+                if months:
+                    update_rollup(conn, cur, selected_table, months, progress)
+            
+            # only reached when every chunk was committed, a failed upload can be retried
+            if file_hash:
+                record_ingest(conn, cur, file_hash, filename, selected_table, rows_total, rows_inserted)
+    finally:
+        if months:
+            invalidate_table(selected_table, months) # cached insights for this bank are stale now
     
-    # get tables and select appropriate one
+    if rows_total == rows_inserted:    
+        progress.log(f"{rows_inserted} rows inserted successfully")
+    else:
+        progress.warning(f"Duplicates Transaction Record Found! {rows_inserted}/{rows_total} rows inserted") 
+    return rows_inserted, rows_total
+
+
+def insert_new_rows(conn, cur, table, df_cleaned, local_infile=False) -> int:
+    # rows already stored for the chunk's date window are dropped before any INSERT is sent
+    df_new = new_rows(cur, table, df_cleaned)
+    if df_new.empty:
+        return 0
+    return storage_backend().insert_frame(conn, cur, table, df_new, local_infile)
+
+
+def ingested_files(digests) -> set:
+    with storage_backend().connection() as (_, cur):
+        return already_ingested(cur, digests)
+
+
+def update_rollup(conn, cur, table, months, progress=None):
+    # monthly totals of only the months this upload touched, a stale rollup would skew every whole-month total
+    for attempt in range(1, ROLLUP_ATTEMPTS + 1):
+        try:
+            refresh_rollup(cur, table, months)
+            conn.commit()
+            return
+        except storage_backend().errors as rollup_error:
+            # deadlocks / lock waits against another job refreshing the same months are worth a retry
+            conn.rollback()
+            if progress is not None:
+                progress.warning(f"Monthly rollup refresh failed (attempt {attempt}/{ROLLUP_ATTEMPTS}): {rollup_error}")
+            if attempt == ROLLUP_ATTEMPTS:
+                raise
+            sleep(attempt)
+
+
+# get tables and select appropriate one
+def find_bank_table(cur, bank_name):
     cur.execute("SHOW TABLES;")
     tables = cur.fetchall()
-    selected_table = None
     for table in tables:
-        if bank_name in table[0]:
-            selected_table = table[0]
-            break
-    
-    col_names, col_dtype, total_fields = schema_template(df_cleaned)
-    log_placeholder.text("Scheme identified! Inserting Data...")
-    sleep(1)
-    
-    try:    
-        rows_inserted = insert_data_to_table(conn=conn, cursor=cur, database=st.secrets['DATABASE'], table=selected_table, total_field=total_fields, col_names=col_names, dataframe=df_cleaned)
-    except Exception as e:
-        print(e)
-    
-    cur.close()
-    conn.close()
-    
-    if df_cleaned.shape[0] == rows_inserted:    
-        log_placeholder.text(f"{rows_inserted} rows inserted successfully")
-        sleep(1)
-        return True
-    else:
-        log_placeholder.warning(f"Duplicates Transaction Record Found! {rows_inserted}/{df_cleaned.shape[0]} rows inserted") 
-        return False       
+        # exact match, <table>_removed_duplicates of migration 2 also contains the bank name
+        if table[0] == bank_name:
+            return table[0]
+    return None
+
+
+def timed_insert(conn, cur, table, df_cleaned, local_infile=False):
+    # runs on the writer thread, timing is handed back to the script thread with the result
+    started = perf_counter()
+    rows_inserted = insert_new_rows(conn, cur, table, df_cleaned, local_infile)
+    return rows_inserted, perf_counter() - started
+
+
+def collect_inserted_chunk(progress, future, bytes_read, total_bytes=None) -> int:
+    # errors of the insert are raised here, the job ends as failed and the file stays out of the ledger
+    rows_inserted, seconds = future.result()
+    progress.add_duration('insert', seconds)
+    if total_bytes:
+        progress.advance(bytes_read, total_bytes)
+    return rows_inserted
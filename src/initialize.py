@@ -1,6 +1,10 @@
 import streamlit as st
-from extract_transactions import get_statement
-from create_insights import Generate_insights
+from jobs import jobs_panel
+from settings import get_setting
+from telemetry import clear_traces, profile_call, session_traces, start_rerun
+
+# pages import their modules when selected, the login form only needs streamlit
+# (pandas, numpy, mysql.connector and pyarrow stay unloaded until a page uses them)
 
 st.set_page_config(page_title="Bank Statement Analytical Dashboard", layout="wide", initial_sidebar_state="auto")
 
@@ -19,6 +23,7 @@ class App():
     def __credentials_check(cusername: str, cpassword: str) -> bool:
         if cusername == st.secrets['CLIENT_USERNAME'] and cpassword == st.secrets['CLIENT_PASSWORD']:
             st.session_state.login_status = True
+            st.session_state.username = cusername
             return True
         return False
 
@@ -42,11 +47,60 @@ class App():
                 selection = st.selectbox("Select an option...", options=options, index=0)
                 
             if selection == options[1]:
+                from extract_transactions import get_statement
                 with st.empty().container(border=True):        
                     get_statement(st)
             elif selection == options[2]:
+                from create_insights import Generate_insights
                 Generate_insights()
 
+            # uploads keep running in the background while other pages are used
+            with st.sidebar:
+                jobs_panel()
+
+            # time spent checking out database connections during this rerun (callbacks included)
+            st.sidebar.metric("DB connect time (this run)", f"{st.session_state.get('db_connect_ms', 0.0):.1f} ms")
+            st.session_state.db_connect_ms = 0.0
+
+            if self.is_admin():
+                self.performance_panel()
+
+    @staticmethod
+    def is_admin() -> bool:
+        return st.session_state.get('username') in get_setting('ADMIN_USERS', [])
+
+    # spans of the hot paths recorded for this session, admin users only
+    @staticmethod
+    def performance_panel():
+        import json
+        import pandas as pd
+        with st.sidebar.expander("Performance"):
+            spans = session_traces()
+            if not spans:
+                st.caption("No spans recorded yet")
+            else:
+                df_spans = pd.DataFrame(spans)
+                last_run = df_spans[df_spans['rerun'] == df_spans['rerun'].max()]
+                st.caption(f"Last run: {last_run['duration_ms'].sum():.1f} ms over {len(last_run)} spans")
+                summary = df_spans.groupby('name').agg(calls=('duration_ms', 'size'), total_ms=('duration_ms', 'sum'),
+                                                       mean_ms=('duration_ms', 'mean'), max_ms=('duration_ms', 'max'),
+                                                       rows=('rows', 'sum'), memory_mb=('memory_delta_mb', 'sum'))
+                st.dataframe(summary.sort_values('total_ms', ascending=False).round(2))
+                st.download_button("Export spans (JSON)", data=json.dumps(spans, default=str, indent=2),
+                                   file_name="performance_spans.json", mime="application/json")
+                st.button("Clear spans", on_click=clear_traces)
+            st.checkbox("Profile next rerun", key="profile_next_rerun")
+            if st.session_state.get('profile_report'):
+                st.download_button("Download profile", data=st.session_state.profile_report,
+                                   file_name="rerun_profile.txt", mime="text/plain")
+                st.text(st.session_state.profile_report[:5000])
+
 # initializing the instance of object if called directly from main file
 if __name__ == "__main__":
-    instant = App()
\ No newline at end of file
+    start_rerun()
+    if st.session_state.get('profile_next_rerun'):
+        # one rerun is profiled, the report is shown in the Performance panel on the next one
+        st.session_state.profile_next_rerun = False
+        instant, st.session_state.profile_report = profile_call(App)
+    else:
+        instant = App()
\ No newline at end of file
@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import streamlit as st
+from settings import get_setting
+
+"""
+Background jobs, the script thread only submits work and polls its status:
+JobRunner -> thread pool held once per server process (job_runner)
+    |- submit -> queues work(reporter, *args), returns the job id
+    |- JobReporter -> progress bar / status line stand-in, every update is written to the job store
+    |- jobs -> latest jobs of an owner, read back from the store on every poll
+jobs_panel -> job status polled from the job store while jobs are running
+job store -> sqlite table ingest_jobs, status survives browser refreshes and marks jobs cut short by a restart
+"""
+
+DEFAULT_JOBS_PATH = os.path.join(".cache", "jobs.sqlite")
+
+# status of jobs that are not finished yet
+ACTIVE_STATUSES = ('queued', 'running')
+
+# seconds between status polls of running jobs
+JOBS_POLL_SECONDS = 1
+
+# jobs running at the same time, each holds one pooled connection for its whole ingest
+INGEST_WRITERS = 3
+
+JOB_COLUMNS = ['job_id', 'owner', 'filename', 'status', 'progress', 'message', 'rows_total', 'rows_inserted', 'submitted_at', 'finished_at']
+
+
+class JobReporter():
+    def __init__(self, runner, job_id: str) -> None:
+        """ Duck types st.progress and st.empty for PipelineProgress, updates land in the job store
+
+        Args:
+            runner (JobRunner): runner owning the job
+            job_id (str): job to update
+        """
+        self.runner = runner
+        self.job_id = job_id
+
+    def progress(self, value: int) -> None:
+        self.runner.update(self.job_id, progress=int(value))
+
+    def text(self, message: str) -> None:
+        self.runner.update(self.job_id, message=str(message))
+
+    def warning(self, message: str) -> None:
+        self.runner.update(self.job_id, message=str(message))
+
+
+class JobRunner():
+    def __init__(self, path: str, workers: int = 2) -> None:
+        """ Thread pool running jobs off the script thread, status kept in a sqlite file
+
+        Args:
+            path (str): sqlite file of the job store
+            workers (int, optional): jobs running at the same time. Defaults to 2.
+        """
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-job")
+        with self.__lock, closing(self.__connect()) as conn, conn:
+            # nothing survives a restart of the server, unfinished jobs of the previous process are reported as such
+            conn.execute("UPDATE ingest_jobs SET status = 'interrupted', finished_at = ? WHERE status IN (?, ?)",
+                         (time.time(), *ACTIVE_STATUSES))
+
+    def submit(self, owner: str, filename: str, work, *args) -> str:
+        """ Queue work(reporter, *args), its return value must be a dict with status, rows_total and rows_inserted
+
+        Args:
+            owner (str): user the job belongs to
+            filename (str): name shown in the job list
+            work (Callable): function running the job
+
+        Returns:
+            str: job id
+        """
+        job_id = uuid.uuid4().hex
+        with self.__lock, closing(self.__connect()) as conn, conn:
+            conn.execute("INSERT INTO ingest_jobs(job_id, owner, filename, status, progress, submitted_at) VALUES (?, ?, ?, 'queued', 0, ?)",
+                         (job_id, owner, filename, time.time()))
+        self.__pool.submit(self.__run, job_id, work, args)
+        return job_id
+
+    def update(self, job_id: str, **fields) -> None:
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with self.__lock, closing(self.__connect()) as conn, conn:
+            conn.execute(f"UPDATE ingest_jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def jobs(self, owner: str, limit: int = 20) -> list:
+        """ Latest jobs of the owner, newest first """
+        with self.__lock, closing(self.__connect()) as conn:
+            rows = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM ingest_jobs WHERE owner = ? ORDER BY submitted_at DESC LIMIT ?",
+                                (owner, limit)).fetchall()
+        return [dict(zip(JOB_COLUMNS, row)) for row in rows]
+
+    def clear_finished(self, owner: str) -> None:
+        with self.__lock, closing(self.__connect()) as conn, conn:
+            conn.execute("DELETE FROM ingest_jobs WHERE owner = ? AND status NOT IN (?, ?)", (owner, *ACTIVE_STATUSES))
+
+    def __run(self, job_id: str, work, args) -> None:
+        self.update(job_id, status='running')
+        try:
+            result = work(JobReporter(self, job_id), *args)
+            self.update(job_id, progress=100, finished_at=time.time(), **result)
+        except Exception as e:
+            self.update(job_id, status='failed', message=f"Data Processing Error! {e}", finished_at=time.time())
+
+    def __connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS ingest_jobs(job_id TEXT PRIMARY KEY, owner TEXT NOT NULL, filename TEXT NOT NULL, "
+                     "status TEXT NOT NULL, progress INTEGER NOT NULL DEFAULT 0, message TEXT, rows_total INTEGER, rows_inserted INTEGER, "
+                     "submitted_at REAL NOT NULL, finished_at REAL)")
+        return conn
+
+
+@st.cache_resource(show_spinner=False)
+def job_runner() -> JobRunner:
+    """ Runner shared by every session of this server process """
+    # capped at the pool size, queued jobs wait for a worker instead of for a connection
+    workers = min(int(get_setting('INGEST_WRITERS', INGEST_WRITERS)), int(get_setting('POOL_SIZE', 5)))
+    return JobRunner(get_setting('JOBS_PATH', DEFAULT_JOBS_PATH), workers=workers)
+
+
+def job_owner() -> str:
+    # jobs follow the login, not the browser session, so a refresh still shows them
+    return st.session_state.get('username', 'anonymous')
+
+
+def jobs_panel() -> None:
+    jobs = job_runner().jobs(job_owner())
+    if not jobs:
+        return
+    active = any(job['status'] in ACTIVE_STATUSES for job in jobs)
+    # poll only while something is running, a finished job triggers one full rerun
+    st.fragment(run_every=JOBS_POLL_SECONDS if active else None)(show_jobs)(active)
+
+
+def show_jobs(was_active: bool) -> None:
+    runner = job_runner()
+    jobs = runner.jobs(job_owner())
+    st.subheader("Ingest Jobs")
+    for job in jobs:
+        st.progress(job['progress'], text=f"{job['filename']}: {job['status']}")
+        if job['message']:
+            st.caption(job['message'])
+    if was_active and not any(job['status'] in ACTIVE_STATUSES for job in jobs):
+        st.rerun()  # new rows are in, cached insights were invalidated by the job
+    st.button(label="Clear finished jobs", on_click=runner.clear_finished, args=(job_owner(),))
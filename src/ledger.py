@@ -0,0 +1,68 @@
+import hashlib
+import pandas as pd
+
+"""
+Ingest ledger (ingest_ledger, created by migration 4):
+file_digest / already_ingested -> uploads whose content was stored before are skipped before parsing
+record_ingest -> remembers a processed file with its row counts
+new_rows -> anti-join of a cleaned frame against the rows stored for its date window, only new rows reach INSERT
+"""
+
+# columns identifying a transaction of a bank table (the bank is the table itself), same as the table's unique key
+FINGERPRINT_COLUMNS = ['transactdate', 'transactdetail', 'amount', 'purchasetype']
+
+
+def file_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def already_ingested(cur, digests: list) -> set:
+    """ Digests of the list found in the ledger
+
+    Args:
+        cur (sql.connection.MySQLCursor):  cursor string as argument
+        digests (list): sha256 hex digests of uploaded files
+
+    Returns:
+        set: digests that were ingested before
+    """
+    if not digests:
+        return set()
+    cur.execute(f"SELECT file_hash FROM ingest_ledger WHERE file_hash IN ({', '.join(len(digests) * ['%s'])})", tuple(digests))
+    return {row[0] for row in cur.fetchall()}
+
+
+def record_ingest(conn, cur, digest: str, filename: str, table: str, rows_total: int, rows_inserted: int) -> None:
+    cur.execute("INSERT IGNORE INTO ingest_ledger(file_hash, filename, bank_table, rows_total, rows_inserted) VALUES (%s, %s, %s, %s, %s)",
+                (digest, filename, table, rows_total, rows_inserted))
+    conn.commit()
+
+
+def fingerprints(df: pd.DataFrame) -> pd.Series:
+    # same values hash the same whether they come from the upload (str dates, float) or the server (date, Decimal)
+    keys = pd.DataFrame({'transactdate': pd.to_datetime(df['transactdate']).dt.strftime('%Y-%m-%d'),
+                         'transactdetail': df['transactdetail'].astype(str),
+                         'amount': (df['amount'].astype(float) * 100).round().astype('int64'),
+                         'purchasetype': df['purchasetype'].astype(str)})
+    return pd.util.hash_pandas_object(keys, index=False)
+
+
+def new_rows(cur, table: str, df: pd.DataFrame) -> pd.DataFrame:
+    """ Rows of df not stored in the table yet, checked with one query over the frame's date window
+
+    Args:
+        cur (sql.connection.MySQLCursor):  cursor string as argument
+        table (str): bank table name
+        df (pd.DataFrame): cleaned transactions
+
+    Returns:
+        pd.DataFrame: rows whose (date, detail, amount, purchase type) fingerprint is not in the table
+    """
+    if df.empty:
+        return df
+    cur.execute(f"SELECT {', '.join(FINGERPRINT_COLUMNS)} FROM {table} WHERE transactdate BETWEEN %s AND %s",
+                (df['transactdate'].min(), df['transactdate'].max()))
+    stored = pd.DataFrame(cur.fetchall(), columns=FINGERPRINT_COLUMNS)
+    if stored.empty:
+        return df
+    return df[~fingerprints(df).isin(fingerprints(stored)).to_numpy()]
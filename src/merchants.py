@@ -0,0 +1,130 @@
+from contextlib import closing
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import pandas as pd
+from settings import get_setting
+
+"""
+Rule driven normalization of transactdetail into canonical merchant names:
+merchant_rules.json -> ordered rule sets (replace / strip / lower / match+set / truncate)
+MerchantNormalizer
+    |- apply -> runs a rule set once per distinct raw value, then maps the column with a dict lookup
+    |- memo -> raw -> canonical results kept in a local sqlite table, so repeat merchants cost a lookup
+"""
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "merchant_rules.json")
+DEFAULT_CACHE_PATH = os.path.join(".cache", "merchants.sqlite")
+
+
+def compile_rule(rule: dict):
+    """ Turn one rule of the config into a str -> str function, patterns are compiled once
+
+    Args:
+        rule (dict): {"replace": pattern, "with": text} | {"match": pattern, "set": text} |
+            {"truncate": separator} | {"strip": true} | {"lower": true}
+    """
+    if "replace" in rule:
+        pattern, replacement = re.compile(rule["replace"]), rule["with"]
+        return lambda value: pattern.sub(replacement, value)
+    if "match" in rule:
+        pattern, canonical = re.compile(rule["match"]), rule["set"]
+        return lambda value: canonical if pattern.search(value) else value
+    if "truncate" in rule:
+        separator = rule["truncate"]
+        return lambda value: value.split(separator)[0]
+    if rule.get("strip"):
+        return str.strip
+    if rule.get("lower"):
+        return str.lower
+    raise ValueError(f"Unknown merchant rule {rule}")
+
+
+def compile_rule_set(rules: list):
+    steps = [compile_rule(rule) for rule in rules]
+
+    def normalize(value: str) -> str:
+        for step in steps:
+            value = step(value)
+        return value
+    return normalize
+
+
+class MerchantNormalizer():
+    def __init__(self, rules: dict, cache_path: str = None) -> None:
+        """ Normalizer for the rule sets of the config
+
+        Args:
+            rules (dict): rule sets as loaded from merchant_rules.json
+            cache_path (str, optional): sqlite file keeping raw -> canonical results. Defaults to no persistence.
+        """
+        self.rules = rules
+        self.debit_generic_types = rules.get("debit_generic_types", [])
+        self.__rule_sets = {name: compile_rule_set(steps) for name, steps in rules.items() if name != "debit_generic_types"}
+        # results of an old version of the rules are never reused
+        self.__version = hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()[:12]
+        self.__memo = {name: {} for name in self.__rule_sets}
+        self.__lock = threading.Lock()
+        self.__cache_path = cache_path
+        if cache_path:
+            self.__load_memo()
+
+    def apply(self, rule_set: str, values: pd.Series) -> pd.Series:
+        """ Normalize a column, each distinct raw value goes through the rules at most once
+
+        Args:
+            rule_set (str): rule set name from the config
+            values (pd.Series): raw transaction details
+
+        Returns:
+            pd.Series: normalized values, same index
+        """
+        memo = self.__memo[rule_set]
+        normalize = self.__rule_sets[rule_set]
+        new_values = {value: normalize(value) for value in values.unique() if isinstance(value, str) and value not in memo}
+        with self.__lock:
+            memo.update(new_values)
+            # jobs clean on their own threads, map reads keys and values separately so it gets a copy no one updates
+            lookup = dict(memo)
+        if new_values:
+            self.__save_memo(rule_set, new_values)
+        return values.map(lookup)
+
+    def __load_memo(self) -> None:
+        with closing(self.__connect()) as conn, conn:
+            for rule_set, raw, canonical in conn.execute("SELECT rule_set, raw, canonical FROM merchant_lookup WHERE rules_version = ?",
+                                                         (self.__version,)):
+                if rule_set in self.__memo:
+                    self.__memo[rule_set][raw] = canonical
+
+    def __save_memo(self, rule_set: str, new_values: dict) -> None:
+        if not self.__cache_path:
+            return
+        with closing(self.__connect()) as conn, conn:
+            conn.executemany("INSERT OR IGNORE INTO merchant_lookup(rules_version, rule_set, raw, canonical) VALUES (?, ?, ?, ?)",
+                             [(self.__version, rule_set, raw, canonical) for raw, canonical in new_values.items()])
+
+    def __connect(self):
+        os.makedirs(os.path.dirname(self.__cache_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.__cache_path, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS merchant_lookup(rules_version TEXT, rule_set TEXT, raw TEXT, canonical TEXT, "
+                     "PRIMARY KEY (rules_version, rule_set, raw))")
+        return conn
+
+
+_normalizer = None
+_normalizer_lock = threading.Lock()
+
+
+def merchant_normalizer() -> MerchantNormalizer:
+    """ Normalizer of this process, built from merchant_rules.json (or the MERCHANT_RULES_PATH secret) on first use """
+    global _normalizer
+    with _normalizer_lock:
+        if _normalizer is None:
+            with open(get_setting('MERCHANT_RULES_PATH', RULES_PATH)) as f:
+                rules = json.load(f)
+            _normalizer = MerchantNormalizer(rules, cache_path=get_setting('MERCHANT_CACHE_PATH', DEFAULT_CACHE_PATH))
+        return _normalizer
@@ -0,0 +1,194 @@
+import argparse
+from queries import BANK_TABLES
+from storage import storage_backend
+from rollups import MONTH_EXPR, ROLLUP_SELECT
+
+"""
+Versioned schema for the bank tables:
+migrate -> applies every migration above the version stored in schema_migrations
+    |- 1: bank tables as the app created them originally (bare columns)
+    |- 2: surrogate key, DATE/DECIMAL(12,2) columns, (transactdate, transactdetail) index, natural-key unique index
+       (rows removed as duplicates are copied to <table>_removed_duplicates)
+    |- 3: monthly_rollup table, filled from the rows already stored
+    |- 4: ingest_ledger table of processed statement files
+    |- embedded DuckDB starts directly at version 4 (DUCKDB_MIGRATIONS), the MariaDB history has no rows to carry over
+explain_queries -> EXPLAIN of the insights queries, run before and after migrate with --explain
+
+Usage: python migrations.py [--target VERSION] [--explain]
+"""
+
+# the same transaction can only be stored once per bank table
+NATURAL_KEY = ['transactdate', 'transactdetail', 'amount', 'purchasetype']
+
+
+def migration_001(cur):
+    for table in BANK_TABLES:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table}(purchasetype VARCHAR(255), transactdetail VARCHAR(255), "
+                    "transactdate VARCHAR(255), amount DECIMAL(6,2))")
+
+
+def migration_002(cur):
+    # every DDL statement commits on its own in MariaDB, each step checks information_schema so a failed run can be resumed
+    duplicate_match = ' AND '.join(f"newer.{col} = older.{col}" for col in NATURAL_KEY)
+    for table in BANK_TABLES:
+        if not column_exists(cur, table, 'id'):
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST")
+        # restating the column types and dropping duplicates are no-ops when repeated
+        cur.execute(f"ALTER TABLE {table} MODIFY purchasetype VARCHAR(6) NOT NULL, MODIFY transactdetail VARCHAR(255) NOT NULL, "
+                    "MODIFY transactdate DATE NOT NULL, MODIFY amount DECIMAL(12,2) NOT NULL")
+        # keep the first copy of rows stored twice before the unique index existed, the other copies are kept aside
+        # in <table>_removed_duplicates (same-day purchases of the same amount at one merchant can be real)
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_removed_duplicates LIKE {table}")
+        cur.execute(f"INSERT IGNORE INTO {table}_removed_duplicates SELECT DISTINCT newer.* FROM {table} newer "
+                    f"JOIN {table} older ON {duplicate_match} AND newer.id > older.id")
+        cur.execute(f"DELETE newer FROM {table} newer JOIN {table} older ON {duplicate_match} AND newer.id > older.id")
+        print(f"  {table}: {cur.rowcount} duplicate rows removed, copied to {table}_removed_duplicates")
+        if not index_exists(cur, table, 'idx_transactdate_detail'):
+            cur.execute(f"ALTER TABLE {table} ADD INDEX idx_transactdate_detail (transactdate, transactdetail)")
+        if not index_exists(cur, table, 'uq_transaction'):
+            cur.execute(f"ALTER TABLE {table} ADD UNIQUE KEY uq_transaction ({', '.join(NATURAL_KEY)})")
+
+
+def column_exists(cur, table: str, column: str) -> bool:
+    cur.execute("SELECT COUNT(*) FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+                (table, column))
+    return cur.fetchone()[0] > 0
+
+
+def index_exists(cur, table: str, index: str) -> bool:
+    cur.execute("SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s",
+                (table, index))
+    return cur.fetchone()[0] > 0
+
+
+def migration_003(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS monthly_rollup(bank_table VARCHAR(32) NOT NULL, month DATE NOT NULL, "
+                "transactdetail VARCHAR(255) NOT NULL, purchasetype VARCHAR(6) NOT NULL, total DECIMAL(14,2) NOT NULL, "
+                "n INT NOT NULL, min_amount DECIMAL(12,2) NOT NULL, max_amount DECIMAL(12,2) NOT NULL, "
+                "PRIMARY KEY (bank_table, month, transactdetail, purchasetype))")
+    for table in BANK_TABLES:
+        cur.execute("INSERT INTO monthly_rollup(bank_table, month, transactdetail, purchasetype, total, n, min_amount, max_amount) "
+                    + ROLLUP_SELECT.format(month=MONTH_EXPR, table=table), (table, '1000-01-01', '9999-12-31'))
+
+
+def migration_004(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS ingest_ledger(file_hash CHAR(64) PRIMARY KEY, filename VARCHAR(255) NOT NULL, "
+                "bank_table VARCHAR(32) NOT NULL, rows_total INT NOT NULL, rows_inserted INT NOT NULL, "
+                "ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+
+
+MIGRATIONS = [
+    (1, "create bank tables", migration_001),
+    (2, "surrogate key, column types, date index and unique natural key", migration_002),
+    (3, "monthly rollup of the bank tables", migration_003),
+    (4, "ledger of ingested statement files", migration_004),
+]
+
+
+def duckdb_schema(cur):
+    # schema of migration 4 in DuckDB DDL, the natural key is enforced by a unique constraint as in MariaDB
+    for table in BANK_TABLES:
+        cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {table}_id_seq")
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table}(id BIGINT PRIMARY KEY DEFAULT nextval('{table}_id_seq'), "
+                    "purchasetype VARCHAR(6) NOT NULL, transactdetail VARCHAR(255) NOT NULL, transactdate DATE NOT NULL, "
+                    f"amount DECIMAL(12,2) NOT NULL, UNIQUE ({', '.join(NATURAL_KEY)}))")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_transactdate_detail ON {table}(transactdate, transactdetail)")
+    cur.execute("CREATE TABLE IF NOT EXISTS monthly_rollup(bank_table VARCHAR(32) NOT NULL, month DATE NOT NULL, "
+                "transactdetail VARCHAR(255) NOT NULL, purchasetype VARCHAR(6) NOT NULL, total DECIMAL(14,2) NOT NULL, "
+                "n INT NOT NULL, min_amount DECIMAL(12,2) NOT NULL, max_amount DECIMAL(12,2) NOT NULL, "
+                "PRIMARY KEY (bank_table, month, transactdetail, purchasetype))")
+    migration_004(cur)
+
+
+DUCKDB_MIGRATIONS = [
+    (4, "bank tables, monthly rollup and ingest ledger", duckdb_schema),
+]
+
+
+def backend_migrations(backend_name: str) -> list:
+    return DUCKDB_MIGRATIONS if backend_name == "duckdb" else MIGRATIONS
+
+
+def current_version(cur) -> int:
+    """ Version of the schema, creates the bookkeeping table on first use
+
+    Args:
+        cur (sql.connection.MySQLCursor):  cursor string as argument
+
+    Returns:
+        int: last applied migration, 0 for an empty database
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations(version INT PRIMARY KEY, description VARCHAR(255), "
+                "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    cur.execute("SELECT MAX(version) FROM schema_migrations")
+    return cur.fetchone()[0] or 0
+
+
+def migrate(conn, cur, target: int = None) -> list:
+    """ Apply pending migrations in order up to target
+
+    Args:
+        conn (sql.connection.MySQLConnection:  connection string as argument
+        cur (sql.connection.MySQLCursor):  cursor string as argument
+        target (int, optional): stop at this version. Defaults to the latest.
+
+    Returns:
+        list: versions applied by this call
+    """
+    applied = []
+    version = current_version(cur)
+    backend = storage_backend()
+    for number, description, migration in backend_migrations(backend.name):
+        if number <= version or (target is not None and number > target):
+            continue
+        try:
+            migration(cur)
+            cur.execute("INSERT INTO schema_migrations(version, description) VALUES (%s, %s)", (number, description))
+            conn.commit()
+            applied.append(number)
+            print(f"Applied migration {number}: {description}")
+        except backend.errors as migration_error:
+            conn.rollback()
+            raise(migration_error)
+    return applied
+
+
+def explain_queries(cur, start_date: str = '2024-01-01', end_date: str = '2024-12-31') -> dict:
+    """ Query plans of the date range queries used by the insights page
+
+    Returns:
+        dict: table name with its EXPLAIN rows
+    """
+    plans = {}
+    for table in BANK_TABLES:
+        cur.execute(f"EXPLAIN SELECT purchasetype, transactdetail, transactdate, amount FROM {table} "
+                    "WHERE transactdate BETWEEN %s AND %s", (start_date, end_date))
+        columns = [col[0] for col in cur.description]
+        plans[table] = [dict(zip(columns, row)) for row in cur.fetchall()]
+    return plans
+
+
+def print_plans(title: str, plans: dict) -> None:
+    print(f"\n{title}")
+    for table, rows in plans.items():
+        for row in rows:
+            if 'explain_value' in row:
+                print(f"  {table}:\n{row['explain_value']}")  # DuckDB returns the plan as text
+                continue
+            print(f"  {table}: type={row.get('type')} key={row.get('key')} rows={row.get('rows')} extra={row.get('Extra')}")
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Create or upgrade the bank tables schema")
+    args.add_argument("--target", type=int, default=None, help="migrate up to this version")
+    args.add_argument("--explain", action="store_true", help="report query plans before and after migrating")
+    options = args.parse_args()
+
+    with storage_backend().connection() as (conn, cur):
+        print(f"Schema version {current_version(cur)}")
+        if options.explain and current_version(cur) >= 1:
+            print_plans("Query plans before migration", explain_queries(cur))
+        migrate(conn, cur, target=options.target)
+        if options.explain:
+            print_plans("Query plans after migration", explain_queries(cur))
+        print(f"Schema version {current_version(cur)}")
@@ -0,0 +1,95 @@
+import os
+import shutil
+import threading
+from datetime import date
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency, cache stays disabled without it
+    pa = None
+
+"""
+Local columnar copy of the bank tables, one parquet file per month:
+<root>/<table>/month=YYYY-MM/part-0.parquet
+read_range -> reads only the months and columns of the requested range (partition + row group pruning)
+write_months -> rewrites the partitions of the given months, used on warm up and after ingest
+"""
+
+COMPLETE_MARKER = "_complete"
+
+# months of one table are rewritten by one thread at a time
+_write_lock = threading.Lock()
+
+
+def available() -> bool:
+    return pa is not None
+
+
+def table_dir(root: str, table: str) -> str:
+    return os.path.join(root, table)
+
+
+def is_warm(root: str, table: str) -> bool:
+    """ True once the whole table was copied to the cache """
+    return os.path.exists(os.path.join(table_dir(root, table), COMPLETE_MARKER))
+
+
+def mark_warm(root: str, table: str) -> None:
+    os.makedirs(table_dir(root, table), exist_ok=True)
+    open(os.path.join(table_dir(root, table), COMPLETE_MARKER), 'w').close()
+
+
+def month_of(dates: pd.Series) -> pd.Series:
+    return pd.to_datetime(dates).dt.strftime('%Y-%m')
+
+
+def write_months(root: str, table: str, df: pd.DataFrame, months) -> None:
+    """ Replace the partitions of the months with the rows of df falling in them
+
+    Args:
+        root (str): cache directory
+        table (str): bank table name
+        df (pd.DataFrame): all rows of the months, as stored in the database
+        months (Iterable[str]): YYYY-MM partitions to rewrite, months without rows are removed
+    """
+    df = df.assign(transactdate=pd.to_datetime(df['transactdate']).dt.date, amount=df['amount'].astype(float))
+    df_months = month_of(df['transactdate'])
+    with _write_lock:
+        for month in months:
+            partition = os.path.join(table_dir(root, table), f"month={month}")
+            rows = df[df_months == month]
+            if rows.empty:
+                shutil.rmtree(partition, ignore_errors=True)
+                continue
+            os.makedirs(partition, exist_ok=True)
+            # write next to the old file and swap, readers never see a partial partition
+            tmp_path = os.path.join(partition, "part-0.parquet.tmp")
+            pq.write_table(pa.Table.from_pandas(rows.sort_values('transactdate'), preserve_index=False), tmp_path)
+            os.replace(tmp_path, os.path.join(partition, "part-0.parquet"))
+
+
+def read_range(root: str, table: str, start_date: str, end_date: str, columns: list) -> pd.DataFrame:
+    """ Rows of the table between two dates (inclusive) read from the monthly partitions
+
+    Args:
+        root (str): cache directory
+        table (str): bank table name
+        start_date (str): start date as YYYY-MM-DD
+        end_date (str): end date as YYYY-MM-DD
+        columns (list): columns to read
+
+    Returns:
+        pd.DataFrame: requested columns, empty when no month of the range is cached
+    """
+    path = table_dir(root, table)
+    if not any(name.startswith("month=") for name in os.listdir(path)):
+        return pd.DataFrame(columns=columns)
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    # month filter prunes whole partitions, date filter uses row group statistics
+    predicate = ((ds.field("month") >= start_date[:7]) & (ds.field("month") <= end_date[:7])
+                 & (ds.field("transactdate") >= pa.scalar(start, pa.date32()))
+                 & (ds.field("transactdate") <= pa.scalar(end, pa.date32())))
+    return dataset.to_table(columns=columns, filter=predicate).to_pandas()
@@ -0,0 +1,201 @@
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import parquet_cache
+from rollups import range_query
+from settings import get_setting
+from storage import storage_backend
+from telemetry import traced
+
+"""
+Cached data access for the insights page:
+fetch_transactions -> memoized on (table, start_date, end_date, table version)
+fetch_aggregate -> same caching for GROUP BY summaries computed on the server
+    |- category and purchasetype totals read whole months from monthly_rollup, raw rows only for partial months
+fetch_accounts_aggregate -> several bank tables fetched in parallel, tagged with a bank column
+compact_frame -> categorical text columns and datetime64 dates for every frame kept in cache or handed to the page
+invalidate_table -> bumps table version after ingest so stale entries are never served
+    |- refreshes the months touched by the ingest in the local parquet cache (when PARQUET_CACHE_DIR is set)
+"""
+
+BANK_TABLES = ("amex_green", "scotia_visa_debit", "scotia_visa_credit")
+TRANSACTION_COLUMNS = ["purchasetype", "transactdetail", "transactdate", "amount"]
+
+# low cardinality text columns, each distinct value is stored once
+CATEGORY_COLUMNS = ["purchasetype", "transactdetail", "bank"]
+
+# summaries pushed down to the server: (query template, result columns)
+AGGREGATE_QUERIES = {
+    'category': ("SELECT transactdetail, SUM(amount) FROM {table} WHERE transactdate BETWEEN %s AND %s "
+                 "GROUP BY transactdetail ORDER BY transactdetail;",
+                 ["transactdetail", "amount"]),
+    'purchasetype': ("SELECT purchasetype, SUM(amount) FROM {table} WHERE transactdate BETWEEN %s AND %s "
+                     "GROUP BY purchasetype;",
+                     ["purchasetype", "amount"]),
+    'daily_store': ("SELECT transactdetail, DATE(transactdate), SUM(amount) FROM {table} WHERE transactdate BETWEEN %s AND %s "
+                    "GROUP BY transactdetail, DATE(transactdate) ORDER BY transactdetail, DATE(transactdate);",
+                    ["transactdetail", "transactdate", "amount"]),
+}
+
+# summaries answered from monthly_rollup plus raw rows of partial months: grouping column
+ROLLUP_KEYS = {'category': 'transactdetail', 'purchasetype': 'purchasetype'}
+
+# cached results expire after CACHE_TTL seconds, at most CACHE_MAX_ENTRIES ranges are kept
+CACHE_TTL = 600
+CACHE_MAX_ENTRIES = 64
+
+
+# per table data version shared by all sessions of the server process
+@st.cache_resource(show_spinner=False)
+def _table_versions() -> dict:
+    return {}
+
+
+def table_version(table: str) -> int:
+    return _table_versions().get(table, 0)
+
+
+def invalidate_table(table: str, months=None) -> None:
+    """ Expire every cached query result of the table, called after new rows are stored
+
+    Args:
+        table (str): bank table which received new rows
+        months (Iterable[str], optional): YYYY-MM months that received rows, refreshed in the
+            parquet cache. Defaults to None.
+    """
+    root = parquet_cache_root()
+    if root and months and parquet_cache.is_warm(root, table):
+        refresh_parquet_months(root, table, sorted(set(months)))
+    # bumped last, a rerun during the refresh must not cache the old partitions under the new version
+    versions = _table_versions()
+    versions[table] = versions.get(table, 0) + 1
+
+
+def parquet_cache_root() -> str:
+    # local columnar cache is optional, enabled by the PARQUET_CACHE_DIR secret
+    if not parquet_cache.available():
+        return None
+    return get_setting('PARQUET_CACHE_DIR')
+
+
+def refresh_parquet_months(root: str, table: str, months: list) -> None:
+    # rows of the touched months are read back from the server so the cache matches the stored (deduplicated) data
+    first_day = f"{months[0]}-01"
+    last_day = (pd.Timestamp(f"{months[-1]}-01") + pd.offsets.MonthEnd(0)).strftime('%Y-%m-%d')
+    query = f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM {validate_table(table)} WHERE transactdate BETWEEN %s AND %s;"
+    parquet_cache.write_months(root, table, _run_query(query, (first_day, last_day), TRANSACTION_COLUMNS), months)
+
+
+def warm_parquet_cache(root: str, table: str) -> None:
+    # first read of a table copies all of it to the cache, later ingests keep it current month by month
+    df = _run_query(f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM {validate_table(table)};", (), TRANSACTION_COLUMNS)
+    if not df.empty:
+        parquet_cache.write_months(root, table, df, parquet_cache.month_of(df['transactdate']).unique())
+    parquet_cache.mark_warm(root, table)
+
+
+def aggregate_frame(kind: str, df: pd.DataFrame) -> pd.DataFrame:
+    # pandas equivalent of AGGREGATE_QUERIES for rows read from the parquet cache
+    keys = {'category': ['transactdetail'], 'purchasetype': ['purchasetype'], 'daily_store': ['transactdetail', 'transactdate']}[kind]
+    return df.groupby(keys, as_index=False, observed=True)['amount'].sum()[AGGREGATE_QUERIES[kind][1]]
+
+
+def validate_table(table: str) -> str:
+    # table names can't be bound as parameters, only known bank tables reach the query
+    if table not in BANK_TABLES:
+        raise ValueError(f"Unknown bank table '{table}'")
+    return table
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # merchants, purchase types and banks repeat on every row, dates become datetime64 instead of date objects
+    if 'transactdate' in df:
+        df = df.assign(transactdate=pd.to_datetime(df['transactdate']))
+    return df.astype({column: 'category' for column in CATEGORY_COLUMNS if column in df})
+
+
+def _run_query(query: str, params: tuple, columns: list) -> pd.DataFrame:
+    backend = storage_backend()
+    with backend.connection() as (_, cur):
+        df = backend.read_frame(cur, query, params, columns)
+    df['amount'] = df['amount'].astype(float)
+    return df
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _fetch_transactions(table: str, start_date: str, end_date: str, version: int) -> pd.DataFrame:
+    root = parquet_cache_root()
+    if root:
+        if not parquet_cache.is_warm(root, table):
+            warm_parquet_cache(root, validate_table(table))
+        return compact_frame(parquet_cache.read_range(root, table, start_date, end_date, TRANSACTION_COLUMNS))
+    query = f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM {validate_table(table)} WHERE transactdate BETWEEN %s AND %s;"
+    return compact_frame(_run_query(query, (start_date, end_date), TRANSACTION_COLUMNS))
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _fetch_aggregate(kind: str, table: str, start_date: str, end_date: str, version: int) -> pd.DataFrame:
+    if parquet_cache_root():
+        return aggregate_frame(kind, _fetch_transactions(table, start_date, end_date, version))
+    query, columns = AGGREGATE_QUERIES[kind]
+    if kind in ROLLUP_KEYS:
+        return compact_frame(_run_query(*range_query(ROLLUP_KEYS[kind], validate_table(table), start_date, end_date), columns))
+    return compact_frame(_run_query(query.format(table=validate_table(table)), (start_date, end_date), columns))
+
+
+@traced('fetch_transactions')
+def fetch_transactions(table: str, start_date: str, end_date: str) -> pd.DataFrame:
+    """ Transactions of the bank table between two dates (inclusive), served from cache on repeat views
+
+    Args:
+        table (str): bank table name
+        start_date (str): start date as YYYY-MM-DD
+        end_date (str): end date as YYYY-MM-DD
+
+    Returns:
+        pd.DataFrame: purchasetype, transactdetail, transactdate, amount
+    """
+    return _fetch_transactions(table, start_date, end_date, table_version(table))
+
+
+def fetch_aggregate(kind: str, table: str, start_date: str, end_date: str) -> pd.DataFrame:
+    """ Summary of the bank table between two dates (inclusive) grouped on the server (or from the parquet cache)
+
+    Args:
+        kind (str): 'category' (per transactdetail), 'purchasetype' (credit/debit totals)
+            or 'daily_store' (per transactdetail and day)
+        table (str): bank table name
+        start_date (str): start date as YYYY-MM-DD
+        end_date (str): end date as YYYY-MM-DD
+
+    Returns:
+        pd.DataFrame: grouping columns and summed amount
+    """
+    return _fetch_aggregate(kind, table, start_date, end_date, table_version(table))
+
+
+def _for_each_table(fetch, tables) -> list:
+    # one worker per table, combined fetch takes about as long as the slowest table
+    if len(tables) == 1:
+        return [fetch(tables[0])]
+    with ThreadPoolExecutor(max_workers=len(tables), initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as pool:
+        return list(pool.map(fetch, tables))
+
+
+@traced('fetch_accounts_aggregate')
+def fetch_accounts_aggregate(kind: str, tables: tuple, start_date: str, end_date: str) -> pd.DataFrame:
+    """ fetch_aggregate of several bank tables, merged into one frame
+
+    Args:
+        kind (str): summary name, see fetch_aggregate
+        tables (tuple): bank table names
+        start_date (str): start date as YYYY-MM-DD
+        end_date (str): end date as YYYY-MM-DD
+
+    Returns:
+        pd.DataFrame: summary rows of every table with a bank column holding the table name
+    """
+    frames = _for_each_table(lambda table: fetch_aggregate(kind, table, start_date, end_date), tables)
+    # categories of the tables differ, the merged columns are made categorical again
+    return compact_frame(pd.concat([df.assign(bank=table) for table, df in zip(tables, frames)], ignore_index=True))
@@ -0,0 +1,89 @@
+import pandas as pd
+
+"""
+Monthly rollup of the bank tables (monthly_rollup, created by migration 3):
+one row per (bank_table, month, transactdetail, purchasetype) with total, count, min and max amount
+refresh_rollup -> recomputes only the months an ingest touched
+split_range -> splits a date range into whole months (answered from the rollup) and partial edge days (raw rows)
+range_query -> one statement summing rollup months and raw edge days for a date range
+"""
+
+# first day of the month of transactdate
+MONTH_EXPR = "transactdate - INTERVAL (DAYOFMONTH(transactdate) - 1) DAY"
+
+ROLLUP_SELECT = ("SELECT %s, {month}, transactdetail, purchasetype, SUM(amount), COUNT(*), MIN(amount), MAX(amount) "
+                 "FROM {table} WHERE transactdate BETWEEN %s AND %s "
+                 "GROUP BY {month}, transactdetail, purchasetype")
+
+
+# whole months from the rollup, partial months at both edges from raw rows
+RANGE_QUERY = ("SELECT {key}, SUM(amount) FROM ("
+               "SELECT transactdetail, purchasetype, total AS amount FROM monthly_rollup WHERE bank_table = %s AND month BETWEEN %s AND %s "
+               "UNION ALL SELECT transactdetail, purchasetype, amount FROM {table} WHERE transactdate BETWEEN %s AND %s "
+               "UNION ALL SELECT transactdetail, purchasetype, amount FROM {table} WHERE transactdate BETWEEN %s AND %s"
+               ") AS ranged GROUP BY {key} ORDER BY {key};")
+
+
+def month_bounds(months: list) -> tuple:
+    """ First day of the earliest and last day of the latest YYYY-MM month """
+    months = sorted(months)
+    last_day = pd.Timestamp(f"{months[-1]}-01") + pd.offsets.MonthEnd(0)
+    return f"{months[0]}-01", last_day.strftime('%Y-%m-%d')
+
+
+def refresh_rollup(cur, table: str, months) -> None:
+    """ Recompute the rollup rows of the months from the raw table, commit is left to the caller
+
+    Args:
+        cur (sql.connection.MySQLCursor):  cursor string as argument
+        table (str): bank table name
+        months (Iterable[str]): YYYY-MM months that received rows
+    """
+    months = sorted(set(months))
+    if not months:
+        return
+    # touched months may not be contiguous, ones in between are recomputed unchanged
+    first_day, last_day = month_bounds(months)
+    cur.execute("DELETE FROM monthly_rollup WHERE bank_table = %s AND month BETWEEN %s AND %s", (table, first_day, last_day))
+    cur.execute("INSERT INTO monthly_rollup(bank_table, month, transactdetail, purchasetype, total, n, min_amount, max_amount) "
+                + ROLLUP_SELECT.format(month=MONTH_EXPR, table=table), (table, first_day, last_day))
+
+
+def split_range(start_date: str, end_date: str) -> dict:
+    """ Split an inclusive date range into whole months and the partial days around them
+
+    Args:
+        start_date (str): start date as YYYY-MM-DD
+        end_date (str): end date as YYYY-MM-DD
+
+    Returns:
+        dict: 'months' (first, last) month start dates for the rollup, 'head' and 'tail' (start, end)
+            day ranges for raw rows; ranges that are empty have start after end
+    """
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    first_full = start if start.day == 1 else start + pd.offsets.MonthBegin(1)
+    last_full_end = end if (end + pd.Timedelta(days=1)).day == 1 else end.replace(day=1) - pd.Timedelta(days=1)
+    day = pd.Timedelta(days=1)
+    fmt = '%Y-%m-%d'
+    if first_full > last_full_end:
+        # no whole month in range, everything comes from raw rows
+        return {'months': (end_date, start_date), 'head': (start_date, end_date), 'tail': (end_date, start_date)}
+    return {'months': (first_full.strftime(fmt), last_full_end.replace(day=1).strftime(fmt)),
+            'head': (start_date, (first_full - day).strftime(fmt)),
+            'tail': ((last_full_end + day).strftime(fmt), end_date)}
+
+
+def range_query(key: str, table: str, start_date: str, end_date: str) -> tuple:
+    """ Statement and parameters summing amount per key column over an inclusive date range
+
+    Args:
+        key (str): grouping column, transactdetail or purchasetype
+        table (str): bank table name
+        start_date (str): start date as YYYY-MM-DD
+        end_date (str): end date as YYYY-MM-DD
+
+    Returns:
+        tuple: query string and its parameters
+    """
+    ranges = split_range(start_date, end_date)
+    return RANGE_QUERY.format(key=key, table=table), (table, *ranges['months'], *ranges['head'], *ranges['tail'])
@@ -0,0 +1,19 @@
+import streamlit as st
+from streamlit.errors import StreamlitSecretNotFoundError
+
+"""
+Secrets lookup kept apart from utils, so pages and panels can read settings without loading pandas or the database driver
+"""
+
+
+def get_setting(name: str, default=None):
+    """ Optional secret with a default, also usable outside of the app (scripts, worker processes without secrets.toml)
+
+    Args:
+        name (str): secret name
+        default (optional): value when the secret or secrets.toml is missing. Defaults to None.
+    """
+    try:
+        return st.secrets.get(name, default)
+    except (FileNotFoundError, StreamlitSecretNotFoundError):
+        return default
@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+import os
+import threading
+import mysql.connector
+import pandas as pd
+import streamlit as st
+from settings import get_setting
+from telemetry import trace
+from utils import insert_data_to_table, mysql_connection, schema_template
+try:
+    import duckdb
+except ImportError:  # optional dependency, only needed with STORAGE_BACKEND = "duckdb"
+    duckdb = None
+
+"""
+Storage backends behind the same connection / cursor calls, chosen with the STORAGE_BACKEND secret:
+storage_backend -> backend of this server process, SQL of the app is written once in the MariaDB dialect
+    |- connection -> context manager yielding (conn, cursor)
+    |- insert_frame -> bulk insert of a cleaned frame, rows already stored are skipped, returns rows inserted
+    |- read_frame -> query result as a DataFrame
+    |- errors -> driver exceptions, caught where a failed statement is rolled back
+MariaDBBackend -> pooled mysql.connector connections of utils, multi-row INSERT IGNORE or LOAD DATA LOCAL INFILE
+DuckDBBackend -> embedded database file, frames are inserted and read back column-wise without row tuples
+"""
+
+DEFAULT_DUCKDB_PATH = os.path.join("data", "dashboard.duckdb")
+
+
+class MariaDBBackend():
+    name = "mariadb"
+    errors = (mysql.connector.Error,)
+
+    def connection(self, allow_local_infile: bool = False):
+        return mysql_connection(allow_local_infile=allow_local_infile)
+
+    def insert_frame(self, conn, cur, table: str, df: pd.DataFrame, local_infile: bool = False) -> int:
+        col_names, col_dtype, total_fields = schema_template(df)
+        return insert_data_to_table(conn=conn, cursor=cur, database=st.secrets['DATABASE'], table=table, total_field=total_fields,
+                                    col_names=col_names, dataframe=df, chunk_size=int(get_setting('INSERT_CHUNK_SIZE', 1000)),
+                                    local_infile=local_infile)
+
+    def read_frame(self, cur, query: str, params: tuple, columns: list) -> pd.DataFrame:
+        cur.execute(query, params)
+        return pd.DataFrame(cur.fetchall(), columns=columns)
+
+
+class DuckDBCursor():
+    def __init__(self, cursor) -> None:
+        """ mysql.connector style cursor over a DuckDB connection
+
+        Args:
+            cursor (duckdb.DuckDBPyConnection): connection of the calling thread
+        """
+        self.raw = cursor
+        self.rowcount = -1
+
+    def execute(self, query: str, params: tuple = ()):
+        # translate the MariaDB dialect used by the app
+        query = query.replace('%s', '?').replace('INSERT IGNORE', 'INSERT OR IGNORE')
+        self.raw.execute(query, params)
+
+    @property
+    def description(self):
+        return self.raw.description
+
+    @property
+    def column_names(self):
+        return tuple(col[0] for col in self.raw.description or ())
+
+    def fetchall(self):
+        return self.raw.fetchall()
+
+    def fetchone(self):
+        return self.raw.fetchone()
+
+    def close(self):
+        self.raw.close()
+
+
+class DuckDBConnection():
+    def __init__(self, cursor) -> None:
+        self.raw = cursor
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        try:
+            self.raw.rollback()
+        except duckdb.TransactionException:
+            pass  # statements run in autocommit, there is nothing to undo
+
+    def close(self):
+        self.raw.close()
+
+
+class DuckDBBackend():
+    name = "duckdb"
+
+    def __init__(self, path: str) -> None:
+        """ Embedded database file, one cursor per checkout so every thread has its own
+
+        Args:
+            path (str): database file, created on first use (':memory:' for a throwaway database)
+        """
+        if duckdb is None:
+            raise ImportError("STORAGE_BACKEND 'duckdb' needs the duckdb package")
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.errors = (duckdb.Error,)
+        self.__database = duckdb.connect(path)
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, allow_local_infile: bool = False):
+        """ Checkout a cursor, allow_local_infile is accepted for parity and ignored
+
+        Yields:
+            Tuple(DuckDBConnection, DuckDBCursor)
+        """
+        with trace('connect_duckdb'), self.__lock:
+            cursor = self.__database.cursor()
+        try:
+            yield DuckDBConnection(cursor), DuckDBCursor(cursor)
+        finally:
+            cursor.close()
+
+    def insert_frame(self, conn, cur, table: str, df: pd.DataFrame, local_infile: bool = False) -> int:
+        # the frame is scanned in place, rows hitting the unique natural key are skipped
+        with trace('insert_frame') as span:
+            columns = ', '.join(df.columns)
+            cur.raw.register('incoming_rows', df)
+            try:
+                rows_inserted = cur.raw.execute(f"INSERT OR IGNORE INTO {table}({columns}) SELECT {columns} FROM incoming_rows").fetchone()[0]
+            finally:
+                cur.raw.unregister('incoming_rows')
+            span['rows'] = rows_inserted
+        return rows_inserted
+
+    def read_frame(self, cur, query: str, params: tuple, columns: list) -> pd.DataFrame:
+        cur.execute(query, params)
+        df = cur.raw.df()
+        df.columns = columns
+        return df
+
+    def close(self) -> None:
+        self.__database.close()
+
+
+@st.cache_resource(show_spinner=False)
+def storage_backend():
+    """ Backend of this server process, MariaDB unless STORAGE_BACKEND is "duckdb" """
+    backend = get_setting('STORAGE_BACKEND', MariaDBBackend.name)
+    if backend == DuckDBBackend.name:
+        return DuckDBBackend(get_setting('DUCKDB_PATH', DEFAULT_DUCKDB_PATH))
+    if backend != MariaDBBackend.name:
+        raise ValueError(f"Unknown STORAGE_BACKEND '{backend}'")
+    return MariaDBBackend()
@@ -0,0 +1,257 @@
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+try:
+    import psutil
+except ImportError:  # optional, memory is read from /proc without it
+    psutil = None
+try:
+    from pyinstrument import Profiler
+except ImportError:  # optional, cProfile is used without it
+    Profiler = None
+
+"""
+Progress and timing of multi stage pipelines:
+PipelineProgress
+    |- stage -> context manager marking one step of the pipeline, records its duration
+    |- timed -> context manager timing work repeated inside a stage (per chunk), bar is left as is
+    |- advance -> moves the progress bar inside the current stage by real work done
+    |- log / warning -> status line shown under the progress bar
+trace / traced -> span (duration, rows, memory delta) of a hot path, kept per session for the Performance panel
+profile_call -> one call under pyinstrument (if installed) or cProfile, returns a text report
+"""
+
+# spans kept per session, oldest are dropped first
+MAX_SPANS = 2000
+# sessions whose spans are kept, nothing tells telemetry a session ended so the least recently active one is dropped
+MAX_SESSIONS = 32
+
+# session key -> {'spans': recent spans, 'reruns': script runs, spans are tagged with the run that produced them}
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+class PipelineProgress():
+    def __init__(self, stages: Dict[str, float], progress_bar=None, log_placeholder=None) -> None:
+        """ Progress reporter shared by every stage of a pipeline
+
+        Args:
+            stages (Dict[str, float]): stage name with its share of the whole bar, shares are normalized
+            progress_bar (optional): st.progress element to advance. Defaults to None.
+            log_placeholder (optional): st.empty element for status lines. Defaults to None.
+        """
+        total_weight = sum(stages.values())
+        self.progress_bar = progress_bar
+        self.log_placeholder = log_placeholder
+        self.fraction = 0.0
+        self.durations = {}
+        self.__bounds = {}
+        self.__current = None
+        self.__started = time.perf_counter()
+        start = 0.0
+        for name, weight in stages.items():
+            end = start + weight / total_weight
+            self.__bounds[name] = (start, end)
+            start = end
+
+    @contextmanager
+    def stage(self, name: str, message: str = None):
+        """ Run one stage, the bar jumps to the end of the stage once it finishes
+
+        Args:
+            name (str): stage name given at construction
+            message (str, optional): status line shown while the stage runs. Defaults to None.
+        """
+        self.__current = name
+        if message:
+            self.log(message)
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_duration(name, time.perf_counter() - started)
+        self.__update(self.__bounds[name][1])
+
+    @contextmanager
+    def timed(self, name: str):
+        """ Add the time spent in the block to the named timing without moving the bar
+
+        Args:
+            name (str): timing name, repeated blocks are summed
+        """
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_duration(name, time.perf_counter() - started)
+
+    def add_duration(self, name: str, seconds: float) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def advance(self, done: float, total: float) -> None:
+        """ Move the bar inside the current stage
+
+        Args:
+            done (float): units of work finished (rows, chunks, bytes)
+            total (float): units of work of the whole stage
+        """
+        if self.__current is None or not total:
+            return
+        start, end = self.__bounds[self.__current]
+        self.__update(start + (end - start) * min(done / total, 1.0))
+
+    def log(self, message: str) -> None:
+        if self.log_placeholder is not None:
+            self.log_placeholder.text(message)
+
+    def warning(self, message: str) -> None:
+        if self.log_placeholder is not None:
+            self.log_placeholder.warning(message)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.__started
+
+    def summary(self) -> str:
+        return ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.durations.items())
+
+    def __update(self, fraction: float) -> None:
+        # the bar never moves backwards
+        self.fraction = max(self.fraction, fraction)
+        if self.progress_bar is not None:
+            self.progress_bar.progress(int(self.fraction * 100))
+
+
+def _session_key() -> str:
+    # threads started without the script run context (ingest writers) are grouped together
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else "background"
+
+
+def _rss_mb() -> float:
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def _rows_of(result):
+    if hasattr(result, "shape"):
+        return int(result.shape[0])
+    if isinstance(result, int) and not isinstance(result, bool):
+        return result
+    return None
+
+
+@contextmanager
+def trace(name: str, **fields):
+    """ Record duration, rows and memory delta of the block for the current session
+
+    Args:
+        name (str): span name shown in the Performance panel
+        fields: extra values stored with the span
+
+    Yields:
+        dict: the span, set span['rows'] inside the block to report rows processed
+    """
+    span = {'name': name, 'rerun': _current_rerun(), 'started': time.time(), 'rows': None,
+            'thread': threading.current_thread().name, **fields}
+    memory_before = _rss_mb()
+    started = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span['duration_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        memory_after = _rss_mb()
+        span['memory_delta_mb'] = round(memory_after - memory_before, 3) if memory_before is not None and memory_after is not None else None
+        with _sessions_lock:
+            _session_entry(_session_key())['spans'].append(span)
+
+
+def traced(name: str = None):
+    """ Decorator form of trace, rows come from the returned frame length or row count """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace(name or func.__qualname__) as span:
+                result = func(*args, **kwargs)
+                span['rows'] = _rows_of(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def session_traces(include_background: bool = True) -> list:
+    """ Spans of the current session (and of background ingest threads), oldest first """
+    key = _session_key()
+    with _sessions_lock:
+        spans = list(_session_entry(key)['spans'])
+        if include_background and key != "background" and "background" in _sessions:
+            spans += list(_sessions["background"]['spans'])
+    return sorted(spans, key=lambda span: span['started'])
+
+
+def clear_traces() -> None:
+    with _sessions_lock:
+        for key in (_session_key(), "background"):
+            if key in _sessions:
+                _sessions[key]['spans'].clear()
+
+
+def start_rerun() -> int:
+    """ Number the script run of the session, spans are tagged with it """
+    with _sessions_lock:
+        entry = _session_entry(_session_key())
+        entry['reruns'] += 1
+        return entry['reruns']
+
+
+def _current_rerun() -> int:
+    with _sessions_lock:
+        entry = _sessions.get(_session_key())
+        return entry['reruns'] if entry else 0
+
+
+def _session_entry(key: str) -> dict:
+    # callers hold _sessions_lock, the session becomes the most recent one
+    entry = _sessions.get(key)
+    if entry is None:
+        entry = _sessions[key] = {'spans': deque(maxlen=MAX_SPANS), 'reruns': 0}
+        while len(_sessions) > MAX_SESSIONS:
+            _sessions.popitem(last=False)
+    _sessions.move_to_end(key)
+    return entry
+
+
+def profile_call(func, *args, **kwargs):
+    """ Run func once under a profiler
+
+    Returns:
+        Tuple: func result and the text report
+    """
+    if Profiler is not None:
+        profiler = Profiler()
+        profiler.start()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            profiler.stop()
+        return result, profiler.output_text(unicode=True)
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(func, *args, **kwargs)
+    finally:
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(40)
+    return result, report.getvalue()
@@ -1,35 +1,150 @@
+from contextlib import contextmanager
 from typing import Tuple
+import os
+import tempfile
+import threading
+import time
 import mysql
 import mysql.connector
+from mysql.connector import pooling
 import pandas as pd
 import streamlit as st
+from settings import get_setting
+from telemetry import traced
 
 
 # TODO-1: MySQL connection Method
+@st.cache_resource(show_spinner=False)
+def get_connection_pool(host: str,
+                        user: str,
+                        port: int,
+                        database: str = None,
+                        pool_size: int = 5,
+                        allow_local_infile: bool = False) -> pooling.MySQLConnectionPool:
+    """ Shared MariaDB connection pool, created once per server process
+
+    Args:
+        host (str): Server Address
+        user (str): Username
+        port (int): port Number
+        database (str, optional): Database Name to connect at login. Defaults to None.
+        pool_size (int, optional): number of connections kept open. Defaults to 5.
+        allow_local_infile (bool, optional): enable LOAD DATA LOCAL INFILE. Defaults to False.
+
+    Returns:
+        pooling.MySQLConnectionPool: pool to checkout connections from
+    """
+    return pooling.MySQLConnectionPool(pool_name=f"{user}_{database}_{int(allow_local_infile)}"[:pooling.CNX_POOL_MAXNAMESIZE],
+                                       pool_size=pool_size,
+                                       pool_reset_session=True,
+                                       host=host, user=user, port=port, password=st.secrets['SERVER_PASSWORD'],
+                                       database=database, allow_local_infile=allow_local_infile)
+
+
+# one semaphore per pool name, sized like the pool, checkouts wait on it instead of failing with pool exhausted
+@st.cache_resource(show_spinner=False)
+def _pool_slots() -> dict:
+    return {}
+
+
+@traced('connect_to_mysql')
 def connect_to_mysql(host: str,
                      user: str,
                      port: int,
-                     database: str = None):
-    """ Connection to MariaDB Server
+                     database: str = None,
+                     allow_local_infile: bool = False):
+    """ Checkout a connection to MariaDB Server from the shared pool
+
+    Waits up to POOL_TIMEOUT seconds for a free connection when all of them are checked out.
+    The connection is pinged before it is handed out and reconnected if the handle
+    went stale, release_connection returns it to the pool.
 
     Args:
         host (str, optional): Server Address. Defaults to 'localhost'.
         user (str, optional): Username. Defaults to 'root'.
         port (int, optional): port Number. Defaults to 3306.
         database (str, optional): Database Name to connect at login. Defaults to None.
+        allow_local_infile (bool, optional): enable LOAD DATA LOCAL INFILE. Defaults to False.
 
     Returns:
         Tuple(connection string, cursor)
     """
 
     try:
-        connection = mysql.connector.connect(host=host, user=user, port=port, password=st.secrets['SERVER_PASSWORD'], database=database)
-        cursor = connection.cursor()
+        started = time.perf_counter()
+        pool = get_connection_pool(host=host, user=user, port=port, database=database,
+                                   pool_size=int(get_setting('POOL_SIZE', 5)), allow_local_infile=allow_local_infile)
+        slots = _pool_slots().setdefault(pool.pool_name, threading.BoundedSemaphore(pool.pool_size))
+        timeout = float(get_setting('POOL_TIMEOUT', 30))
+        if not slots.acquire(timeout=timeout):
+            raise mysql.connector.errors.PoolError(f"No free connection in pool '{pool.pool_name}' after {timeout:.0f}s")
+        try:
+            connection = pool.get_connection()
+        except mysql.connector.Error:
+            slots.release()
+            raise
+        try:
+            connection.ping(reconnect=True, attempts=3, delay=1)
+            cursor = connection.cursor()
+        except mysql.connector.Error:
+            # a pooled connection only goes back to the queue through close(), a failed health check must not leak it
+            try:
+                connection.close()
+            finally:
+                slots.release()
+            raise
+        record_connect_time((time.perf_counter() - started) * 1000)
         return connection, cursor
     except mysql.connector.Error as conn_err:
         raise(conn_err)
 
 
+def release_connection(connection, cursor) -> None:
+    """ Close the cursor and return a connection of connect_to_mysql to its pool
+
+    Args:
+        connection (PooledMySQLConnection): connection from connect_to_mysql
+        cursor (sql.connection.MySQLCursor): its cursor
+    """
+    try:
+        cursor.close()
+    finally:
+        try:
+            connection.close()
+        finally:
+            _pool_slots()[connection.pool_name].release()
+
+
+@contextmanager
+def mysql_connection(allow_local_infile: bool = False):
+    """ Checkout a pooled connection for the server configured in secrets and always return it
+
+    Args:
+        allow_local_infile (bool, optional): enable LOAD DATA LOCAL INFILE. Defaults to False.
+
+    Yields:
+        Tuple(connection string, cursor)
+    """
+    connection, cursor = connect_to_mysql(host=st.secrets['HOST'], user=st.secrets['SERVER_USERNAME'], port=int(st.secrets['PORT']),
+                                          database=st.secrets['DATABASE'], allow_local_infile=allow_local_infile)
+    try:
+        yield connection, cursor
+    finally:
+        release_connection(connection, cursor)
+
+
+def record_connect_time(elapsed_ms: float) -> None:
+    """ Keep time spent checking out connections in this session for the connect metric
+
+    Args:
+        elapsed_ms (float): milliseconds spent on checkout and health check
+    """
+    try:
+        st.session_state['db_connect_ms'] = st.session_state.get('db_connect_ms', 0.0) + elapsed_ms
+    except Exception:
+        pass  # outside of a streamlit session
+
+
 # TODO-2: Database Creation Method
 def create_database(cursor, dbname: str) -> bool:
     """ Drop database if exists and create new one
@@ -88,15 +203,21 @@ def create_table(cursor,
 
 
 # TODO-4: Inserting Data to Table
-# Another task; find what datatypes for data will be passed as argument (list, string, dictionary, tuple)
+@traced('insert_data_to_table')
 def insert_data_to_table(conn, 
                          cursor, 
                          database:str, 
                          table:str,
                          total_field:str,
                          col_names: str,
-                         dataframe:pd.DataFrame) -> int:
-    """Insert data to given table from the database provided as an argument
+                         dataframe:pd.DataFrame,
+                         chunk_size: int = 1000,
+                         local_infile: bool = False) -> int:
+    """Bulk insert data to given table from the database provided as an argument
+
+    Rows are sent as multi-row ``INSERT IGNORE`` statements of ``chunk_size`` rows
+    with one commit per chunk, rows hitting a unique key are skipped by the server.
+    A failing chunk is rolled back and its error raised.
 
     Args:
         conn (sql.connection.MySQLConnection:  connection string as argument
@@ -106,24 +227,70 @@ def insert_data_to_table(conn,
         total_field (str): total fields for columns
         col_names (str): string literal contains name of columns
         dataframe (pd.DataFrame): pandas dataframe which holds data
+        chunk_size (int, optional): rows per INSERT statement and commit. Defaults to 1000.
+        local_infile (bool, optional): load the frame with LOAD DATA LOCAL INFILE instead,
+            the connection must be opened with allow_local_infile. Defaults to False.
     Returns:
-        bool: returns True/False if query executed successfully or not
+        int: number of rows inserted, skipped duplicates are not counted
     """
 
+    if dataframe.empty:
+        return 0
+    if local_infile:
+        return load_data_local_infile(conn, cursor, database, table, col_names, dataframe)
+
     row_inserted = 0
-    for _, row in dataframe.iterrows():
+    rows = dataframe.astype(object).where(dataframe.notnull(), None).to_numpy()
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        values = ', '.join(len(chunk) * [f"({total_field})"])
+        ins_qry = f"INSERT IGNORE INTO {database}.{table}({col_names}) VALUES {values}"
         try:
-            ins_qry = f"INSERT INTO {database}.{table}({col_names}) VALUES ({total_field})"
-            cursor.execute(ins_qry, tuple(row))
-            if cursor.rowcount == 1:
-                row_inserted += 1
-                conn.commit()
+            cursor.execute(ins_qry, tuple(chunk.ravel()))
+            row_inserted += cursor.rowcount
+            conn.commit()
         except mysql.connector.Error as insert_error:
-            print(insert_error, " at ", row)
-            continue
+            # chunks before this one stay committed, the caller must not treat the frame as stored
+            conn.rollback()
+            raise(insert_error)
     return row_inserted
 
 
+def load_data_local_infile(conn,
+                           cursor,
+                           database:str,
+                           table:str,
+                           col_names: str,
+                           dataframe:pd.DataFrame) -> int:
+    """Load dataframe to given table through a temporary csv and LOAD DATA LOCAL INFILE
+
+    Args:
+        conn (sql.connection.MySQLConnection:  connection opened with allow_local_infile
+        cursor (sql.connection.MySQLCursor):  cursor string as argument
+        database (str): database name to insert table 
+        table (str): table name to which the data will be inserted
+        col_names (str): string literal contains name of columns
+        dataframe (pd.DataFrame): pandas dataframe which holds data
+    Returns:
+        int: number of rows inserted, duplicates are ignored by the server
+    """
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', newline='', delete=False) as tmp:
+        dataframe.to_csv(tmp, header=False, index=False, lineterminator='\n', na_rep='\\N')
+    try:
+        load_qry = (f"LOAD DATA LOCAL INFILE '{tmp.name}' IGNORE INTO TABLE {database}.{table} "
+                    "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+                    f"LINES TERMINATED BY '\\n' ({col_names})")
+        cursor.execute(load_qry)
+        row_inserted = cursor.rowcount
+        conn.commit()
+        return row_inserted
+    except mysql.connector.Error as load_error:
+        conn.rollback()
+        raise(load_error)
+    finally:
+        os.remove(tmp.name)
+
+
 # TODO-5: Fetch Data Method
 def get_data_from_table(cursor, database:str, query: str) -> list:
     """ Pull data from the table in the database passed in argument
@@ -178,7 +345,7 @@ def schema_template(dataframe) -> Tuple[str, str]:
         if col_type == 'object':
             types += f'{col_name} VARCHAR(255), '
         elif col_type == 'float64':
-            types += f'{col_name} DECIMAL(6,2), '
+            types += f'{col_name} DECIMAL(12,2), '
         elif col_type == 'int64':
             types += f'{col_name} INT, '
     col_datatypes = types[:-2]
@@ -0,0 +1,32 @@
+import os
+import pandas as pd
+import pytest
+from extract_transactions import clean_data, prepare_dataframe, read_statement
+
+"""
+Regression of the vectorized prepare_dataframe -> clean_data against the row-wise implementation it replaced:
+data/<bank>_sample.csv -> statement in the bank's export layout (hinted and off-hint dates, missing values, transfers, payroll)
+data/<bank>_sample_expected.csv -> output of the previous implementation for the same file
+"""
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+SAMPLES = [
+    ("amex_credit_sample", "amex_green"),
+    ("scotia_credit_sample", "scotia_visa_credit"),
+    ("scotia_debit_sample", "scotia_visa_debit"),
+]
+
+
+@pytest.fixture(autouse=True)
+def merchant_cache_in_tmp(tmp_path, monkeypatch):
+    # the merchant memo table is created relative to the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.mark.parametrize("sample, bank_name", SAMPLES)
+def test_cleaned_statement_matches_previous_output(sample, bank_name):
+    chunks = read_statement(os.path.join(DATA_DIR, f"{sample}.csv"), bank_name, chunksize=4)
+    cleaned = pd.concat([clean_data(prepare_dataframe(chunk, bank_name)) for chunk in chunks], ignore_index=True)
+    expected = pd.read_csv(os.path.join(DATA_DIR, f"{sample}_expected.csv"))
+    pd.testing.assert_frame_equal(cleaned, expected)